@@ -41,7 +41,7 @@ This module is similar, except:
 I welcome questions and comments at <software @ discworld.dyndns.org>.
 '''
 
-__version__ = '3.1'
+__version__ = '3.2'
 __author__ = 'Charles Cazabon <software @ discworld.dyndns.org>'
 
 #
@@ -51,8 +51,7 @@ __author__ = 'Charles Cazabon <software @ discworld.dyndns.org>'
 import string
 import UserDict
 import sys
-import shlex
-import cStringIO
+import re
 from types import *
 
 
@@ -109,6 +108,16 @@ class ParsingError (ConfParserException):
 
 debug = 0
 
+# Configuration file tokens:  whitespace, comments, quoted strings (which may
+# not span a closing quote), words (which may contain quotes after the first
+# character), and any other single character.  This is how shlex, in its
+# non-POSIX mode, splits the file with these word characters.
+wordchars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_' \
+    + '|/.,$^\\():;@-+?<>!%&*`~'
+token_re = re.compile (r'''[ \t\r\n]+|#[^\n]*\n?|"[^"]*"|'[^']*'|'''
+    r'''[%s][%s"']*|.''' % (re.escape (wordchars), re.escape (wordchars)),
+    re.S)
+
 #
 # Helper functions
 #
@@ -170,10 +179,13 @@ class ConfParser:
     def __init__ (self, defaults = {}):
         '''Constructor.
         '''
-        self.__rawdata = []
+        # Section names in file order, and each section's options as a
+        # dictionary of lists of raw values
         self.__sectionlist = []
-        self.__sections = []
+        self.__sections = {}
         self.__defaults = SmartDict ()
+        # Interpolated values by (section, option), as returned by get ()
+        self.__resolved = {}
 
         try:
             for key in defaults.keys ():
@@ -189,59 +201,73 @@ class ConfParser:
         if type (filelist) not in (ListType, TupleType):
             filelist = [filelist]
 
+        data = []
         try:
             for filename in filelist:
                 log ('Reading configuration file "%s"' % filename)
                 f = open (filename, 'r')
-                self.__rawdata = self.__rawdata + f.readlines ()
+                data.append (f.read ())
                 f.close ()
-    
+
         except IOError, txt:
             raise ParsingError, 'error reading configuration file (%s)' % txt
 
-        self.__parse ()
+        # The files are parsed as one stream
+        self.__parse (string.join (data, '\n'))
+        self.__resolve ()
         return self
 
     #######################################
-    def __parse (self):
-        '''Parse the read-in configuration file.
+    def __tokens (self, data):
+        '''Split data into tokens:  words, quoted strings (quotes included)
+        and single punctuation characters, skipping whitespace and comments.
+        '''
+        tokens = []
+        for token in token_re.findall (data):
+            c = token[0]
+            if c in ' \t\r\n#':
+                continue
+            if c in '"\'' and (len (token) == 1 or token[-1] != c):
+                raise ParsingError, 'no closing quotation'
+            tokens.append (token)
+        return tokens
+
+    #######################################
+    def __parse (self, data):
+        '''Parse configuration file contents data in a single pass over its
+        tokens.
         '''
-        config = string.join (self.__rawdata, '\n')
-        f = cStringIO.StringIO (config)
-        lex = shlex.shlex (f)
-        lex.wordchars = lex.wordchars + '|/.,$^\\():;@-+?<>!%&*`~'
+        tokens = self.__tokens (data)
+        ntokens = len (tokens)
+        i = 0
         section_name = ''
-        option_name = ''
-        option_value = ''
-        
-        while 1:
-            token = lex.get_token ()
-            if token == '':
-                break
+        section = None
+
+        while i < ntokens:
+            token = tokens[i]
+            i = i + 1
 
-            if not (section_name):
+            if not section_name:
                 if token != '[':
                     raise ParsingError, 'expected section start, got %s' % token
-                section_name = ''
+                name = []
                 while 1:
-                    token = lex.get_token ()
+                    if i >= ntokens:
+                        raise ParsingError, 'expected section end, hit EOF'
+                    token = tokens[i]
+                    i = i + 1
                     if token == ']':
                         break
-                    if token == '':
-                        raise ParsingError, 'expected section end, hit EOF'
-                    if section_name:
-                        section_name = section_name + ' '
-                    section_name = section_name + token
-                if not section_name:
+                    name.append (token)
+                if not name:
                     raise ParsingError, 'expected section name, got nothing'
 
-                section = SmartDict ()
                 # Collapse case on section names
-                section_name = string.lower (section_name)
-                if section_name in self.__sectionlist:
+                section_name = string.lower (string.join (name, ' '))
+                if self.__sections.has_key (section_name):
                     raise DuplicateSectionError, \
                         'duplicate section (%s)' % section_name
-                section['__name__'] = section_name
+                section = {'__name__' : [section_name]}
                 continue
 
             if token == '=':
@@ -249,54 +275,84 @@ class ConfParser:
 
             if token == '[':
                 # Start new section
-                lex.push_token (token)
-                if section_name in self.__sectionlist:
-                    raise DuplicateSectionError, \
-                        'duplicate section (%s)' % section_name
-                if section['__name__'] == 'default':
-                    self.__defaults.update (section)
-                self.__sectionlist.append (section_name)
-                self.__sections.append (section.copy ())
+                i = i - 1
+                self.__add_section (section_name, section)
                 section_name = ''
                 continue
 
-            if not option_name:
-                option_name = token
-                token = lex.get_token ()
-                if token != '=':
-                    raise ParsingError, 'Expected =, got %s' % token
-
-                token = lex.get_token ()
-                if token in ('[', '='):
-                    raise ParsingError, 'expected option value, got %s' % token
-                option_value = token
-
-                if option_value[0] in ('"', "'") and option_value[0] == option_value[-1]:
-                    option_value = option_value[1:-1]
-                                  
-                if section.has_key (option_name):
-                    if type (section[option_name]) == ListType:
-                        section[option_name].append (option_value)
-                    else:
-                        section[option_name] = [section[option_name], option_value]
-                else:
-                    section[option_name] = option_value
-                
-                option_name = ''
-                
-        # Done parsing        
+            option_name = token
+            if i >= ntokens or tokens[i] != '=':
+                raise ParsingError, 'Expected =, got %s' \
+                    % (tokens[i:i + 1] or [''])[0]
+            if i + 1 >= ntokens:
+                raise ParsingError, 'expected option value, hit EOF'
+            option_value = tokens[i + 1]
+            i = i + 2
+            if option_value in ('[', '='):
+                raise ParsingError, 'expected option value, got %s' \
+                    % option_value
+
+            if option_value[0] in ('"', "'") \
+                    and option_value[0] == option_value[-1]:
+                option_value = option_value[1:-1]
+
+            try:
+                section[option_name].append (option_value)
+            except KeyError:
+                section[option_name] = [option_value]
+
+        # Done parsing
         if section_name:
-            if section_name in self.__sectionlist:
-                raise DuplicateSectionError, \
-                    'duplicate section (%s)' % section_name
-            if section['__name__'] == 'default':
-                self.__defaults.update (section)
-            self.__sectionlist.append (section_name)
-            self.__sections.append (section.copy ())
-        
+            self.__add_section (section_name, section)
+
         if not self.__sectionlist:
             raise MissingSectionHeaderError, 'no section headers in file'
 
+    #######################################
+    def __add_section (self, section_name, section):
+        if self.__sections.has_key (section_name):
+            raise DuplicateSectionError, \
+                'duplicate section (%s)' % section_name
+        if section_name == 'default':
+            for (option, value) in section.items ():
+                self.__defaults[option] = value
+        self.__sectionlist.append (section_name)
+        self.__sections[section_name] = section
+
+    #######################################
+    def __resolve (self):
+        '''Interpolate every option value once.  Values whose interpolation
+        fails are left out, so that get () reports the error if asked for
+        them.
+        '''
+        resolved = {}
+        for section_name in self.__sectionlist:
+            for (option, rawval) in self.__sections[section_name].items ():
+                try:
+                    value = self.__interpolate (option, rawval,
+                        self.__defaults)
+                except ConfParserException:
+                    continue
+                if len (value) == 1:
+                    value = value[0]
+                else:
+                    value = tuple (value)
+                resolved[(section_name, option)] = value
+        self.__resolved = resolved
+
+    #######################################
+    def __interpolate (self, option, rawval, expand):
+        '''Return the list of values of option, with "%" interpolations
+        expanded from expand.
+        '''
+        try:
+            return map (lambda part, expand=expand: part % expand, rawval)
+        except KeyError, txt:
+            raise NoOptionError, 'missing option (%s)' % txt
+        except (TypeError, ValueError), txt:
+            raise InterpolationError, 'invalid conversion or specification' \
+                ' for option %s (%s (%s))' % (option, rawval, txt)
+
     #######################################
     def defaults (self):
         '''Return a dictionary containing the passed-in instance-wide defaults.
@@ -305,88 +361,80 @@ class ConfParser:
 
     #######################################
     def has_section (self, section):
-        '''Indicates whether the named section is present in the configuration. 
+        '''Indicates whether the named section is present in the configuration.
         The default section is not acknowledged.
         '''
         section = string.lower (section)
-        if section not in self.sections ():
+        if section == 'default' or not self.__sections.has_key (section):
             return 0
         return 1
-        
+
     #######################################
     def sections (self):
         '''Return a list of sections in the configuration file.
         '''
-        s = self.__sectionlist[:]
-        try:
-            # Remove 'default' section from returned list
-            i = s.index ('default')
-            del s[i]
-        except ValueError:
-            # No default section
-            pass
-        
-        return s
+        return filter (lambda s: s != 'default', self.__sectionlist)
 
     #######################################
     def options (self, section):
         '''Return list of options in section.
         '''
         try:
-            s = self.__sectionlist.index (string.lower (section))
+            return self.__sections[string.lower (section)].keys ()
 
-        except ValueError:
+        except KeyError:
             raise NoSectionError, 'missing section:  "%s"' % section
 
-        return self.__sections[s].keys ()
-
     #######################################
     def get (self, section, option, raw=0, _vars={}):
-        '''Get an option value for the provided section. All the "%" 
-        interpolations are expanded in the return values, based on the defaults 
-        passed into the constructor, as well as the options _vars provided, 
+        '''Get an option value for the provided section. All the "%"
+        interpolations are expanded in the return values, based on the defaults
+        passed into the constructor, as well as the options _vars provided,
         unless the raw argument is true.  __vars contents must be lists.
         '''
+        section_name = string.lower (section)
+        if not raw and not _vars:
+            try:
+                value = self.__resolved[(section_name, option)]
+            except KeyError:
+                pass
+            else:
+                if type (value) == TupleType:
+                    return list (value)
+                return value
 
         try:
-            s = self.__sectionlist.index (string.lower (section))
-            options = self.__sections[s]
-        except ValueError:
+            options = self.__sections[section_name]
+        except KeyError:
             raise NoSectionError, 'missing section (%s)' % section
 
-        expand = self.__defaults.copy ()
-        expand.update (_vars)
-        
         if not options.has_key (option):
+            expand = self.__defaults.copy ()
+            expand.update (_vars)
             if expand.has_key (option):
                 return expand[option]
             raise NoOptionError, 'section [%s] missing option (%s)' \
                 % (section, option)
 
         rawval = options[option]
-        
         if raw:
-            return rawval
+            if len (rawval) == 1:
+                return rawval[0]
+            return rawval[:]
 
+        if _vars:
+            expand = self.__defaults.copy ()
+            expand.update (_vars)
+        else:
+            expand = self.__defaults
         try:
-            value = []
-            if type (rawval) != ListType:
-                rawval = [rawval]
-            for part in rawval:
-                try:
-                    part = part % expand
-                except:
-                    raise
-                value.append (part)
-            if len (value) == 1:
-                return value[0]
-            return value                
-        except KeyError, txt:
+            value = self.__interpolate (option, rawval, expand)
+        except NoOptionError:
             raise NoOptionError, 'section [%s] missing option (%s)' \
                 % (section, option)
-        except TypeError, txt:
-            raise InterpolationError, 'invalid conversion or specification' \
-                ' for option %s (%s (%s))' % (option, rawval, txt)
+        if len (value) == 1:
+            return value[0]
+        return value
 
     #######################################
     def getint (self, section, option):
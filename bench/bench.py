@@ -0,0 +1,346 @@
+#!/usr/bin/python
+'''bench.py - Microbenchmarks for pymsgauth.
+Copyright (C) 2001 Charles Cazabon <software @ discworld.dyndns.org>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of version 2 of the GNU General Public License
+as published by the Free Software Foundation.  A copy of this license should
+be included in the file COPYING.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+usage:  bench.py [-q | -f] [-r repeat] [-k pattern] [-o results.json]
+
+Runs each benchmark against synthetic data built in a scratch directory:
+pymsgauthrc files with thousands of token_recipient entries, outbound
+messages from 1 KB to 50 MB, qsecretary notices of several sizes, and token
+stores holding 10^3 to 10^6 tokens.  Mail is delivered to fake-mail-prog,
+which discards it.
+
+    -q          quick run; smallest sizes only
+    -f          full run; adds the 10^6 token stores
+    -r repeat   timed runs per benchmark (default 5)
+    -k pattern  only run benchmarks whose name contains pattern
+    -o file     write results to file as JSON (default stdout)
+
+Results hold the minimum, median, mean and maximum time of each benchmark in
+seconds; compare two runs with compare.py.
+'''
+
+import sys
+import os
+import time
+import getopt
+import shutil
+import tempfile
+import rfc822
+import json
+
+bench_dir = os.path.dirname (os.path.abspath (__file__))
+sys.path.insert (0, os.path.dirname (bench_dir))
+
+import ConfParser
+import pymsgauth
+
+fake_mail_prog = os.path.join (bench_dir, 'fake-mail-prog')
+
+# Sizes used by a normal, quick (-q) and full (-f) run
+sizes = {
+    'recipients' : ((1000, 10000), (1000,), (1000, 10000)),
+    'message' : ((1024, 1024 * 1024, 50 * 1024 * 1024), (1024,),
+        (1024, 1024 * 1024, 50 * 1024 * 1024)),
+    'notice' : ((1024, 100 * 1024, 10 * 1024 * 1024), (1024,),
+        (1024, 100 * 1024, 10 * 1024 * 1024)),
+    'tokens' : ((1000, 10000, 100000), (1000,),
+        (1000, 10000, 100000, 1000000)),
+}
+
+header = '''From: me@example.net
+To: qmail@list.cr.yp.to
+Subject: benchmark
+Message-ID: <bench@example.net>
+
+'''
+
+notice_top = '''From: "The qsecretary program" <qmail-sc.1-x@list.cr.yp.to>
+To: me@example.net
+Subject: confirm
+
+Hi. This is the qsecretary program. Please confirm.
+
+--- Below this line is the top of your message.
+
+X-pymsgauth-token: %s
+'''
+
+#############################
+def write_file (path, data):
+    f = open (path, 'wb')
+    f.write (data)
+    f.close ()
+
+#############################
+def write_body (f, size):
+    line = 'x' * 71 + '\n'
+    block = line * 1024
+    while size > len (block):
+        f.write (block)
+        size = size - len (block)
+    f.write ((line * (size / len (line) + 1))[:size])
+
+#############################
+def make_config_dir (path, recipients=3, token_store='dotfile'):
+    '''Create configuration/data directory path, with a pymsgauthrc naming
+    recipients token_recipient addresses.
+    '''
+    os.mkdir (path)
+    lines = ['[default]\n',
+        'secret = benchmark\n',
+        'confirmation_address = me@example.net\n',
+        'mail_prog = %s\n' % fake_mail_prog,
+        'token_store = %s\n' % token_store,
+        'token_recipient = qmail@list.cr.yp.to\n']
+    for i in range (recipients - 1):
+        lines.append ('token_recipient = list%d@lists%d.example.org\n'
+            % (i, i % 97))
+    write_file (os.path.join (path, 'pymsgauthrc'), ''.join (lines))
+    return path
+
+#############################
+def use_config_dir (path):
+    os.environ['PYMSGAUTH_DIR'] = path
+    pymsgauth.read_config ()
+
+#############################
+def token_for (i):
+    import sha
+    return sha.new ('bench %d' % i).hexdigest ()
+
+#############################
+def populate (store, count):
+    if isinstance (store, pymsgauth.DbmTokenStore):
+        db, lockfd = store._open ()
+        try:
+            stamp = str (int (time.time ()))
+            for i in xrange (count):
+                db[token_for (i)] = stamp
+        finally:
+            store._close (db, lockfd)
+    else:
+        for i in xrange (count):
+            store.add (token_for (i))
+
+#
+# Benchmarks.  Each takes the scratch directory and a size, and returns
+# (run, reset):  run is timed, reset (if not None) is called untimed before
+# each run.
+#
+
+#############################
+def bench_confparser (scratch, count):
+    path = make_config_dir (os.path.join (scratch, 'conf-%d' % count),
+        count)
+    rcfile = os.path.join (path, 'pymsgauthrc')
+    def run ():
+        ConfParser.ConfParser ().read (rcfile)
+    return run, None
+
+#############################
+def bench_read_config (scratch, count, cached):
+    path = make_config_dir (os.path.join (scratch,
+        'read-%d-%d' % (count, cached)), count)
+    cache = os.path.join (path,
+        'pymsgauthrc' + pymsgauth.config_cache_suffix)
+    # Writes the cache
+    use_config_dir (path)
+    def reset ():
+        pymsgauth.config_stamp = None
+        if not cached and os.path.exists (cache):
+            os.unlink (cache)
+    return pymsgauth.read_config, reset
+
+#############################
+def bench_sendmail_wrapper (scratch, size):
+    path = make_config_dir (os.path.join (scratch, 'mail-%d' % size))
+    msgfile = os.path.join (scratch, 'message-%d' % size)
+    f = open (msgfile, 'wb')
+    f.write (header)
+    write_body (f, size)
+    f.close ()
+    use_config_dir (path)
+    def reset ():
+        sys.stdin = open (msgfile, 'rb')
+    def run ():
+        pymsgauth.sendmail_wrapper (['qmail@list.cr.yp.to'])
+    return run, reset
+
+#############################
+def make_notice (scratch, size, token):
+    noticefile = os.path.join (scratch, 'notice-%d' % size)
+    f = open (noticefile, 'wb')
+    f.write (notice_top % token)
+    f.write (header)
+    write_body (f, size)
+    f.close ()
+    return noticefile
+
+#############################
+def bench_extract_original_message (scratch, size):
+    noticefile = make_notice (scratch, size, token_for (0))
+    state = {}
+    def reset ():
+        state['msg'] = rfc822.Message (open (noticefile, 'rb'))
+    def run ():
+        pymsgauth.extract_original_message (state['msg'])
+    return run, reset
+
+#############################
+def bench_confirm_notice (scratch, size):
+    path = make_config_dir (os.path.join (scratch, 'confirm-%d' % size))
+    token = token_for (0)
+    noticefile = make_notice (scratch, size, token)
+    use_config_dir (path)
+    state = {}
+    def reset ():
+        pymsgauth.get_token_store ().add (token)
+        state['fp'] = open (noticefile, 'rb')
+    def run ():
+        if pymsgauth.confirm_notice (state['fp']) != pymsgauth.CONFIRMED:
+            raise RuntimeError, 'notice not confirmed'
+    return run, reset
+
+#############################
+def bench_check_token (scratch, count, token_store):
+    path = make_config_dir (os.path.join (scratch,
+        'tokens-%s-%d' % (token_store, count)), token_store=token_store)
+    use_config_dir (path)
+    populate (pymsgauth.get_token_store (), count)
+    state = {'next' : count}
+    def reset ():
+        # A fresh outstanding token for each run
+        state['token'] = token_for (state['next'])
+        state['next'] = state['next'] + 1
+        pymsgauth.get_token_store ().add (state['token'])
+    def run ():
+        if not pymsgauth.check_token (None, state['token']):
+            raise RuntimeError, 'token not found'
+    return run, reset
+
+#############################
+def benchmarks (mode):
+    '''Return a list of (name, setup function, arguments).
+    '''
+    cases = []
+    for count in sizes['recipients'][mode]:
+        cases.append (('confparser.parse.%d' % count, bench_confparser,
+            (count,)))
+        cases.append (('read_config.uncached.%d' % count, bench_read_config,
+            (count, 0)))
+        cases.append (('read_config.cached.%d' % count, bench_read_config,
+            (count, 1)))
+    for size in sizes['message'][mode]:
+        cases.append (('sendmail_wrapper.%d' % size, bench_sendmail_wrapper,
+            (size,)))
+    for size in sizes['notice'][mode]:
+        cases.append (('extract_original_message.%d' % size,
+            bench_extract_original_message, (size,)))
+        cases.append (('confirm_notice.%d' % size, bench_confirm_notice,
+            (size,)))
+    for token_store in pymsgauth.token_stores.keys ():
+        for count in sizes['tokens'][mode]:
+            cases.append (('check_token.%s.%d' % (token_store, count),
+                bench_check_token, (count, token_store)))
+    cases.sort ()
+    return cases
+
+#############################
+def measure (run, reset, repeat):
+    times = []
+    for i in range (repeat):
+        if reset:
+            reset ()
+        start = time.time ()
+        run ()
+        times.append (time.time () - start)
+    times.sort ()
+    return {
+        'repeat' : repeat,
+        'min' : times[0],
+        'median' : times[len (times) / 2],
+        'mean' : sum (times) / len (times),
+        'max' : times[-1],
+    }
+
+#############################
+def revision ():
+    import subprocess
+    try:
+        p = subprocess.Popen (['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=bench_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = p.communicate ()[0].strip ()
+    except OSError:
+        return None
+    return out or None
+
+#############################
+def main ():
+    usage = 'usage:  bench.py [-q | -f] [-r repeat] [-k pattern] ' \
+        '[-o results.json]\n'
+    try:
+        opts, args = getopt.getopt (sys.argv[1:], 'qfr:k:o:')
+    except getopt.GetoptError:
+        sys.stderr.write (usage)
+        sys.exit (100)
+    mode = 0
+    repeat = 5
+    pattern = ''
+    output = None
+    for (opt, value) in opts:
+        if opt == '-q':
+            mode = 1
+        elif opt == '-f':
+            mode = 2
+        elif opt == '-r':
+            repeat = int (value)
+        elif opt == '-k':
+            pattern = value
+        elif opt == '-o':
+            output = value
+
+    results = {}
+    scratch = tempfile.mkdtemp (prefix='pymsgauth-bench-')
+    stdin = sys.stdin
+    try:
+        for (name, setup, setup_args) in benchmarks (mode):
+            if pattern not in name:
+                continue
+            sys.stderr.write ('%s ... ' % name)
+            run, reset = apply (setup, (scratch,) + setup_args)
+            results[name] = measure (run, reset, repeat)
+            sys.stdin = stdin
+            sys.stderr.write ('%.6f s\n' % results[name]['median'])
+    finally:
+        shutil.rmtree (scratch, ignore_errors=1)
+
+    report = {
+        'revision' : revision (),
+        'python' : sys.version.split ()[0],
+        'date' : time.strftime ('%Y-%m-%dT%H:%M:%SZ', time.gmtime ()),
+        'results' : results,
+    }
+    if output:
+        f = open (output, 'w')
+    else:
+        f = sys.stdout
+    json.dump (report, f, indent=1, sort_keys=1)
+    f.write ('\n')
+
+if __name__ == '__main__':
+    main ()
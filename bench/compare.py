@@ -0,0 +1,76 @@
+#!/usr/bin/python
+'''compare.py - Compare two sets of pymsgauth benchmark results.
+Copyright (C) 2001 Charles Cazabon <software @ discworld.dyndns.org>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of version 2 of the GNU General Public License
+as published by the Free Software Foundation.  A copy of this license should
+be included in the file COPYING.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+usage:  compare.py [-t threshold] old.json new.json
+
+Prints the median time of each benchmark in both runs and their ratio, and
+exits 1 if any benchmark got slower by more than threshold (a fraction;
+default 0.10).
+'''
+
+import sys
+import getopt
+import json
+
+#############################
+def main ():
+    usage = 'usage:  compare.py [-t threshold] old.json new.json\n'
+    try:
+        opts, args = getopt.getopt (sys.argv[1:], 't:')
+    except getopt.GetoptError:
+        sys.stderr.write (usage)
+        sys.exit (100)
+    if len (args) != 2:
+        sys.stderr.write (usage)
+        sys.exit (100)
+    threshold = 0.10
+    for (opt, value) in opts:
+        if opt == '-t':
+            threshold = float (value)
+
+    old = json.load (open (args[0]))
+    new = json.load (open (args[1]))
+    sys.stdout.write ('%-40s %12s %12s %8s\n' % ('benchmark',
+        old['revision'] or args[0], new['revision'] or args[1], 'ratio'))
+    names = {}
+    for name in old['results'].keys () + new['results'].keys ():
+        names[name] = 1
+    names = names.keys ()
+    names.sort ()
+    regressions = 0
+    for name in names:
+        try:
+            before = old['results'][name]['median']
+            after = new['results'][name]['median']
+        except KeyError:
+            sys.stdout.write ('%-40s (only in one run)\n' % name)
+            continue
+        ratio = after / max (before, 1e-9)
+        mark = ''
+        if ratio > 1 + threshold:
+            mark = '  slower'
+            regressions = regressions + 1
+        elif ratio < 1 - threshold:
+            mark = '  faster'
+        sys.stdout.write ('%-40s %12.6f %12.6f %8.2f%s\n' % (name, before,
+            after, ratio, mark))
+    if regressions:
+        sys.exit (1)
+
+if __name__ == '__main__':
+    main ()
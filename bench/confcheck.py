@@ -0,0 +1,133 @@
+#!/usr/bin/python
+'''confcheck.py - Check that ConfParser reads configuration files the same
+way as an earlier version of it.
+Copyright (C) 2001 Charles Cazabon <software @ discworld.dyndns.org>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of version 2 of the GNU General Public License
+as published by the Free Software Foundation.  A copy of this license should
+be included in the file COPYING.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+usage:  confcheck.py old-ConfParser.py [file ...]
+
+Reads a set of sample configurations, and each file given, with both the
+ConfParser.py next to this directory and the old one named (for instance
+one saved with "git show <revision>:ConfParser.py"), and compares the
+sections, the value and raw value of every option, and any exception
+raised.  A ValueError from the old get () counts as the InterpolationError
+the new one raises instead, and a file either parser cannot read at all
+only has to fail with the other, with whatever exception.
+
+Exits 1 if the two parsers differ.
+'''
+
+import sys
+import os
+import imp
+import tempfile
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (
+    sys.argv[0])), os.pardir))
+import ConfParser
+
+samples = [
+    '[default]\nsecret = abc\nmail_prog = /usr/bin/x -a\n'
+        'token_recipient = a@b.c\ntoken_recipient = \'d@e.f\'\n',
+    '# comment\n[default]\n  x = "a b" # comment\ny=%(x)s-1\n'
+        '[Other Sect]\nz = %(y)s\nw = \'q\'\n',
+    '[default]\nx = \'%(nope)s\'\n[a]\nb = %(x)s\n',
+    '[default]\npct = 100%\nother = 1\n',
+    '[default]\nx = %d\n',
+    '[default]\nx = %(home)\n',
+    '[ two words ]\nk = v\nk = w\nk = %%x\n',
+    '[default]\nx = a\'b"c\ny = "a"b\n',
+    'x = 1\n',
+    '[default\nx = 1\n',
+    '[default]\nx = \n',
+    '[default]\nx 1\n',
+    '[default]\nx = "abc\n',
+    '[a]\n[a]\n',
+    '',
+]
+
+#############################
+def error (exc):
+    name = exc.__class__.__name__
+    if name == 'ValueError':
+        return 'InterpolationError'
+    return name
+
+#############################
+def outcome (module, path):
+    '''Return everything module's parser makes of the file at path.'''
+    try:
+        parser = module.ConfParser ({'home' : '/home/user'})
+        parser.read (path)
+    except Exception:
+        return ['unreadable']
+    result = [parser.sections (), parser.has_section ('default')]
+    sections = parser.sections ()
+    sections.sort ()
+    for section in sections + ['default']:
+        try:
+            options = parser.options (section)
+        except Exception, txt:
+            result.append ((section, error (txt)))
+            continue
+        options.sort ()
+        for option in options:
+            for raw in (0, 1):
+                try:
+                    value = parser.get (section, option, raw)
+                except Exception, txt:
+                    value = error (txt)
+                result.append ((section, option, raw, value))
+    return result
+
+#############################
+def main ():
+    if len (sys.argv) < 2:
+        sys.stderr.write ('usage:  confcheck.py old-ConfParser.py '
+            '[file ...]\n')
+        sys.exit (100)
+    old = imp.load_source ('ConfParser_old', sys.argv[1])
+
+    checks = []
+    for sample in samples:
+        fd, path = tempfile.mkstemp ()
+        os.write (fd, sample)
+        os.close (fd)
+        checks.append ((repr (sample), path, 1))
+    for path in sys.argv[2:]:
+        checks.append ((path, path, 0))
+
+    differences = 0
+    for (name, path, temporary) in checks:
+        try:
+            before = outcome (old, path)
+            after = outcome (ConfParser, path)
+        finally:
+            if temporary:
+                os.unlink (path)
+        if before != after:
+            differences = differences + 1
+            sys.stdout.write ('%s:\n  old:  %s\n  new:  %s\n'
+                % (name, before, after))
+    sys.stdout.write ('%d of %d configurations read differently\n'
+        % (differences, len (checks)))
+    if differences:
+        sys.exit (1)
+    sys.exit (0)
+
+#############################
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+'''startup.py - Startup-time benchmark and budget check for the pymsgauth
+entry scripts.
+Copyright (C) 2001 Charles Cazabon <software @ discworld.dyndns.org>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of version 2 of the GNU General Public License
+as published by the Free Software Foundation.  A copy of this license should
+be included in the file COPYING.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+usage:  startup.py [-r repeat] [-b milliseconds] [-m modules] [-o file]
+
+Runs each entry script as a fresh process on the cheapest realistic input
+(a message passed through pymsgauth-mail unsigned, an ordinary list message
+given to pymsgauth-confirm, an empty pymsgauth-clean run), with no daemon
+running.  Reports the wall-clock time of each, its overhead over starting
+the bare interpreter, and the number of modules it imported beyond the
+interpreter's own.
+
+    -r repeat   runs per script (default 20)
+    -b ms       fail if any script's median overhead exceeds this
+                (default 50)
+    -m modules  fail if any script imports more than this many modules
+                (default 30)
+    -o file     write results to file as JSON (default stdout), in the same
+                form as bench.py, so compare.py can compare runs
+
+Exits 1 if a budget is exceeded.
+'''
+
+import sys
+import os
+import time
+import getopt
+import shutil
+import tempfile
+import subprocess
+import json
+
+bench_dir = os.path.dirname (os.path.abspath (__file__))
+top_dir = os.path.dirname (bench_dir)
+
+import bench
+
+list_message = '''From: someone@example.org
+To: qmail@list.cr.yp.to
+Subject: an ordinary list message
+
+body
+'''
+
+outbound_message = '''From: me@example.net
+To: friend@example.com
+Subject: not for a list
+
+body
+'''
+
+# Run a script, then write the names of the modules it loaded to the file
+# named by PYMSGAUTH_BENCH_MODULES
+module_wrapper = '''import sys
+def dump ():
+    f = open (modules_file, 'w')
+    f.write ('\\n'.join (sys.modules.keys ()))
+    f.close ()
+import atexit, os
+modules_file = os.environ['PYMSGAUTH_BENCH_MODULES']
+atexit.register (dump)
+if len (sys.argv) > 1:
+    sys.argv = sys.argv[1:]
+    sys.path[0] = os.path.dirname (sys.argv[0])
+    execfile (sys.argv[0], {'__name__' : '__main__'})
+'''
+
+#############################
+def cases ():
+    '''Return a list of (name, command, input).
+    '''
+    def script (name):
+        return os.path.join (top_dir, name)
+    return [
+        ('python', [], ''),
+        ('pymsgauth-mail.passthrough',
+            [script ('pymsgauth-mail'), 'friend@example.com'],
+            outbound_message),
+        ('pymsgauth-confirm.ignored', [script ('pymsgauth-confirm')],
+            list_message),
+        ('pymsgauth-clean', [script ('pymsgauth-clean')], ''),
+    ]
+
+#############################
+def run_once (command, data, env):
+    start = time.time ()
+    p = subprocess.Popen (command, stdin=subprocess.PIPE, env=env)
+    p.communicate (data)
+    if p.returncode:
+        raise RuntimeError, '%s exited %d' % (command, p.returncode)
+    return time.time () - start
+
+#############################
+def main ():
+    usage = 'usage:  startup.py [-r repeat] [-b milliseconds] ' \
+        '[-m modules] [-o file]\n'
+    try:
+        opts, args = getopt.getopt (sys.argv[1:], 'r:b:m:o:')
+    except getopt.GetoptError:
+        sys.stderr.write (usage)
+        sys.exit (100)
+    repeat = 20
+    budget = 50.0
+    module_budget = 30
+    output = None
+    for (opt, value) in opts:
+        if opt == '-r':
+            repeat = int (value)
+        elif opt == '-b':
+            budget = float (value)
+        elif opt == '-m':
+            module_budget = int (value)
+        elif opt == '-o':
+            output = value
+
+    scratch = tempfile.mkdtemp (prefix='pymsgauth-startup-')
+    results = {}
+    modules = {}
+    try:
+        env = os.environ.copy ()
+        env['PYMSGAUTH_DIR'] = bench.make_config_dir (os.path.join (scratch,
+            'conf'))
+        env['PYMSGAUTH_SOCKET'] = os.path.join (scratch, 'no-daemon')
+        env['PYMSGAUTH_BENCH_MODULES'] = os.path.join (scratch, 'modules')
+        for (name, command, data) in cases ():
+            # Once untimed, which also writes the configuration cache
+            run_once ([sys.executable] + (command or ['-c', 'pass']), data,
+                env)
+            times = []
+            for i in range (repeat):
+                times.append (run_once ([sys.executable]
+                    + (command or ['-c', 'pass']), data, env))
+            times.sort ()
+            results[name] = {
+                'repeat' : repeat,
+                'min' : times[0],
+                'median' : times[len (times) / 2],
+                'mean' : sum (times) / len (times),
+                'max' : times[-1],
+            }
+            run_once ([sys.executable, '-c', module_wrapper] + command, data,
+                env)
+            modules[name] = open (env['PYMSGAUTH_BENCH_MODULES']).read (
+                ).split ('\n')
+    finally:
+        shutil.rmtree (scratch, ignore_errors=1)
+
+    base = results['python']['median']
+    base_modules = len (modules['python'])
+    over = 0
+    for (name, command, data) in cases ()[1:]:
+        overhead = (results[name]['median'] - base) * 1000.0
+        imported = len (modules[name]) - base_modules
+        results[name]['overhead_ms'] = overhead
+        results[name]['modules'] = imported
+        mark = ''
+        if overhead > budget or imported > module_budget:
+            mark = '  over budget'
+            over = 1
+        sys.stderr.write ('%-30s %8.2f ms  +%6.2f ms  +%3d modules%s\n'
+            % (name, results[name]['median'] * 1000.0, overhead, imported,
+            mark))
+
+    report = {
+        'revision' : bench.revision (),
+        'python' : sys.version.split ()[0],
+        'date' : time.strftime ('%Y-%m-%dT%H:%M:%SZ', time.gmtime ()),
+        'results' : results,
+    }
+    if output:
+        f = open (output, 'w')
+    else:
+        f = sys.stdout
+    json.dump (report, f, indent=1, sort_keys=1)
+    f.write ('\n')
+    if over:
+        sys.exit (1)
+
+if __name__ == '__main__':
+    main ()
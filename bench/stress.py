@@ -0,0 +1,522 @@
+#!/usr/bin/python
+'''stress.py - End-to-end stress test of the qsecretary confirmation loop.
+Copyright (C) 2001 Charles Cazabon <software @ discworld.dyndns.org>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of version 2 of the GNU General Public License
+as published by the Free Software Foundation.  A copy of this license should
+be included in the file COPYING.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+usage:  stress.py [-n messages] [-s senders] [-c confirmers] [-k cleaners]
+                  [-d fraction] [-F fraction] [-t token_store]
+                  [-f token_format] [-S] [-D] [-O name=value] [-w seconds]
+                  [-o file]
+
+Runs the whole cycle against one scratch configuration/data directory:
+sender threads pipe messages to pymsgauth-mail, whose mail_prog
+(stress-mail-prog) hands them to a fake list server in this process.  The
+server answers each signed message with a qsecretary notice, which
+confirmer threads pipe to pymsgauth-confirm; the confirmation comes back to
+the server through mail_prog.  Cleaner threads run pymsgauth-clean all the
+while.  Some notices are delivered twice, to different confirmers at once,
+as qmail does when a delivery is retried.  Once a message is confirmed, the
+server may also send a forged notice quoting its (used) token from a new
+reply address, which must not be answered.
+
+    -n messages     messages to send (default 200)
+    -s senders      concurrent pymsgauth-mail runs (default 4)
+    -c confirmers   concurrent pymsgauth-confirm runs (default 4)
+    -k cleaners     concurrent pymsgauth-clean loops (default 1)
+    -d fraction     fraction of notices delivered twice (default 0.2)
+    -F fraction     fraction of confirmed tokens sent a forged notice
+                    (default 0.1)
+    -t store        token_store (default dotfile)
+    -f format       token_format (default random)
+    -S              spool confirmations, with pymsgauth-flush running
+    -D              run pymsgauth-daemon, so requests go through it
+    -O name=value   set any other pymsgauthrc value (may be repeated)
+    -w seconds      how long to wait for outstanding confirmations once
+                    everything is sent (default 30)
+    -o file         write results to file as JSON (default stdout), in the
+                    same form as bench.py
+
+Reports throughput, latency percentiles for each command and for the whole
+loop, and any double confirmations (a notice answered more than once),
+lost tokens (a signed message never confirmed) or forged notices
+answered.  Exits 1 if there were any, or if a command failed.
+'''
+
+import sys
+import os
+import time
+import getopt
+import shutil
+import tempfile
+import subprocess
+import socket
+import threading
+import Queue
+import random
+import json
+
+bench_dir = os.path.dirname (os.path.abspath (__file__))
+top_dir = os.path.dirname (bench_dir)
+
+import bench
+
+stress_mail_prog = os.path.join (bench_dir, 'stress-mail-prog')
+
+list_address = 'qmail@list.cr.yp.to'
+confirmation_address = 'me@example.net'
+
+message = '''From: me@example.net
+To: qmail@list.cr.yp.to
+Subject: stress %(n)d
+Message-ID: <stress.%(n)d@example.net>
+
+body %(n)d
+'''
+
+notice = '''From: "The qsecretary program" <%(reply)s>
+To: me@example.net
+Subject: confirm
+
+Hi. This is the qsecretary program. Please confirm.
+
+--- Below this line is the top of your message.
+
+%(header)s
+'''
+
+#############################
+def percentiles (values):
+    values = values[:]
+    values.sort ()
+    if not values:
+        return {'repeat' : 0}
+    def pct (p):
+        return values[min (len (values) - 1, int (len (values) * p))]
+    return {
+        'repeat' : len (values),
+        'min' : values[0],
+        'median' : pct (0.5),
+        'p90' : pct (0.9),
+        'p99' : pct (0.99),
+        'mean' : sum (values) / len (values),
+        'max' : values[-1],
+    }
+
+#############################
+class ListServer:
+    '''Fake qsecretary-protected list:  accepts mail from stress-mail-prog,
+    answers signed messages with notices (put on the notices queue, twice
+    for a fraction of them), and records the confirmations sent back.  A
+    fraction of confirmed messages get a forged notice from a new reply
+    address.
+    '''
+    #############################
+    def __init__ (self, path, notices, duplicates, forgeries):
+        self.path = path
+        self.notices = notices
+        self.duplicates = duplicates
+        self.forgeries = forgeries
+        self.lock = threading.Lock ()
+        # Signed messages seen, by token:  [time sent, reply address]
+        self.tokens = {}
+        # Time each notice's message was sent, by reply address
+        self.replies = {}
+        # Header quoted by each notice, by reply address
+        self.headers = {}
+        # Reply addresses of forged notices, and confirmations sent to them
+        self.forged = {}
+        self.forged_confirmed = 0
+        # Confirmations received, by reply address
+        self.confirmed = {}
+        self.unsigned = 0
+        self.stray = 0
+        self.loop_times = []
+        self.server = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind (path)
+        self.server.listen (128)
+        thread = threading.Thread (target=self.serve)
+        thread.setDaemon (1)
+        thread.start ()
+
+    #############################
+    def serve (self):
+        while 1:
+            conn, addr = self.server.accept ()
+            thread = threading.Thread (target=self.handle, args=(conn,))
+            thread.setDaemon (1)
+            thread.start ()
+
+    #############################
+    def handle (self, conn):
+        data = []
+        while 1:
+            s = conn.recv (65536)
+            if not s:
+                break
+            data.append (s)
+        data = ''.join (data)
+        length, rest = data.split (':', 1)
+        args = rest[:int (length)].split ('\0')
+        msg = rest[int (length) + 1:]
+        code = self.receive (args, msg)
+        conn.sendall (str (code))
+        conn.close ()
+
+    #############################
+    def receive (self, args, msg):
+        recips = []
+        i = 0
+        while i < len (args):
+            if args[i] == '-f':
+                i = i + 1
+            elif args[i][:1] != '-':
+                recips.append (args[i])
+            i = i + 1
+        now = time.time ()
+        for recip in recips:
+            if recip.startswith ('qmail-sc.'):
+                forge = None
+                self.lock.acquire ()
+                if self.forged.has_key (recip):
+                    self.forged_confirmed = self.forged_confirmed + 1
+                    self.lock.release ()
+                    continue
+                times = self.confirmed.get (recip, 0) + 1
+                self.confirmed[recip] = times
+                if not self.replies.has_key (recip):
+                    self.stray = self.stray + 1
+                elif times == 1:
+                    self.loop_times.append (now - self.replies[recip])
+                    if random.random () < self.forgeries:
+                        forge = 'qmail-sc.%d-forged-%s@list.cr.yp.to' % (
+                            len (self.forged), os.urandom (4).encode ('hex'))
+                        self.forged[forge] = 1
+                self.lock.release ()
+                if forge:
+                    # The token is used now; anyone who saw it on the list
+                    # could try to get another message confirmed with it
+                    self.notices.put (notice % {'reply' : forge,
+                        'header' : self.headers[recip]})
+                continue
+            header = msg.split ('\n\n', 1)[0]
+            token = None
+            for line in header.split ('\n'):
+                if line.lower ().startswith ('x-pymsgauth-token:'):
+                    token = line.split (':', 1)[1].strip ()
+            if token is None:
+                self.lock.acquire ()
+                self.unsigned = self.unsigned + 1
+                self.lock.release ()
+                continue
+            self.lock.acquire ()
+            reply = 'qmail-sc.%d-%s@list.cr.yp.to' % (len (self.tokens),
+                os.urandom (4).encode ('hex'))
+            self.tokens[token] = [now, reply]
+            self.replies[reply] = now
+            self.headers[reply] = header
+            self.lock.release ()
+            text = notice % {'reply' : reply, 'header' : header}
+            self.notices.put (text)
+            if random.random () < self.duplicates:
+                self.notices.put (text)
+        return 0
+
+#############################
+def run_command (command, data, env):
+    '''Run command with data on stdin; return (exit code, seconds taken).
+    '''
+    start = time.time ()
+    p = subprocess.Popen (command, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    out, err = p.communicate (data)
+    return p.returncode, time.time () - start, err
+
+#############################
+class Workers:
+    '''Threads running a command repeatedly, recording exit codes and
+    latencies.
+    '''
+    #############################
+    def __init__ (self):
+        self.lock = threading.Lock ()
+        self.times = []
+        self.codes = {}
+        self.errors = []
+        self.threads = []
+
+    #############################
+    def record (self, code, elapsed, err):
+        self.lock.acquire ()
+        self.times.append (elapsed)
+        self.codes[code] = self.codes.get (code, 0) + 1
+        if err.strip ():
+            self.errors.append (err.strip ())
+        self.lock.release ()
+
+    #############################
+    def start (self, count, func):
+        for i in range (count):
+            thread = threading.Thread (target=func)
+            thread.setDaemon (1)
+            thread.start ()
+            self.threads.append (thread)
+
+    #############################
+    def join (self):
+        for thread in self.threads:
+            thread.join ()
+
+#############################
+def write_config (path, options):
+    os.mkdir (path)
+    lines = ['[default]\n',
+        'secret = stress\n',
+        'confirmation_address = %s\n' % confirmation_address,
+        'mail_prog = %s\n' % sys.executable,
+        'mail_prog = %s\n' % stress_mail_prog,
+        'token_recipient = %s\n' % list_address,
+        'confirm_domain = list.cr.yp.to\n',
+        'log_level = ERROR\n']
+    for (name, value) in options:
+        lines.append ('%s = %s\n' % (name, value))
+    bench.write_file (os.path.join (path, 'pymsgauthrc'), ''.join (lines))
+    return path
+
+#############################
+def main ():
+    usage = 'usage:  stress.py [-n messages] [-s senders] [-c confirmers] ' \
+        '[-k cleaners] [-d fraction] [-F fraction] [-t token_store] ' \
+        '[-f token_format] [-S] [-D] [-O name=value] [-w seconds] ' \
+        '[-o file]\n'
+    try:
+        opts, args = getopt.getopt (sys.argv[1:], 'n:s:c:k:d:F:t:f:SDO:w:o:')
+        count = 200
+        senders = 4
+        confirmers = 4
+        cleaners = 1
+        duplicates = 0.2
+        forgeries = 0.1
+        options = []
+        spool = 0
+        daemon = 0
+        wait = 30.0
+        output = None
+        for (opt, value) in opts:
+            if opt == '-n':
+                count = int (value)
+            elif opt == '-s':
+                senders = int (value)
+            elif opt == '-c':
+                confirmers = int (value)
+            elif opt == '-k':
+                cleaners = int (value)
+            elif opt == '-d':
+                duplicates = float (value)
+            elif opt == '-F':
+                forgeries = float (value)
+            elif opt == '-t':
+                options.append (('token_store', value))
+            elif opt == '-f':
+                options.append (('token_format', value))
+            elif opt == '-S':
+                spool = 1
+            elif opt == '-D':
+                daemon = 1
+            elif opt == '-O':
+                name, value = value.split ('=', 1)
+                options.append ((name.strip (), value.strip ()))
+            elif opt == '-w':
+                wait = float (value)
+            elif opt == '-o':
+                output = value
+    except (getopt.GetoptError, ValueError):
+        sys.stderr.write (usage)
+        sys.exit (100)
+    if spool:
+        options.append (('confirm_spool', 'spool'))
+
+    scratch = tempfile.mkdtemp (prefix='pymsgauth-stress-')
+    helpers = []
+    try:
+        env = os.environ.copy ()
+        env['PYMSGAUTH_DIR'] = write_config (os.path.join (scratch, 'conf'),
+            options)
+        env['PYMSGAUTH_SOCKET'] = os.path.join (scratch, 'daemon.sock')
+        env['PYMSGAUTH_STRESS_SOCKET'] = os.path.join (scratch, 'list.sock')
+        notices = Queue.Queue ()
+        server = ListServer (env['PYMSGAUTH_STRESS_SOCKET'], notices,
+            duplicates, forgeries)
+        def script (name):
+            return [sys.executable, os.path.join (top_dir, name)]
+
+        if daemon:
+            helpers.append (subprocess.Popen (script ('pymsgauth-daemon'),
+                env=env))
+            for i in range (500):
+                if os.path.exists (env['PYMSGAUTH_SOCKET']):
+                    break
+                time.sleep (0.01)
+        if spool:
+            helpers.append (subprocess.Popen (script ('pymsgauth-flush')
+                + ['-j', '4', '-i', '0.1'], stdout=subprocess.PIPE, env=env))
+
+        stop = threading.Event ()
+        sending = Workers ()
+        confirming = Workers ()
+        cleaning = Workers ()
+        next_message = [0]
+        next_lock = threading.Lock ()
+        def send ():
+            while 1:
+                next_lock.acquire ()
+                n = next_message[0]
+                next_message[0] = n + 1
+                next_lock.release ()
+                if n >= count:
+                    return
+                sending.record (*run_command (script ('pymsgauth-mail')
+                    + [list_address], message % {'n' : n}, env))
+        def confirm ():
+            while not stop.isSet ():
+                try:
+                    text = notices.get (timeout=0.1)
+                except Queue.Empty:
+                    continue
+                confirming.record (*run_command (script ('pymsgauth-confirm'),
+                    text, env))
+                notices.task_done ()
+        def clean ():
+            while not stop.isSet ():
+                cleaning.record (*run_command (script ('pymsgauth-clean'), '',
+                    env))
+
+        start = time.time ()
+        sending.start (senders, send)
+        confirming.start (confirmers, confirm)
+        cleaning.start (cleaners, clean)
+        sending.join ()
+        sent = time.time ()
+        # Wait for every signed message to be confirmed, or for the notices
+        # to run out and the deadline to pass
+        deadline = time.time () + wait
+        while time.time () < deadline:
+            server.lock.acquire ()
+            outstanding = len (server.tokens) - len (server.loop_times)
+            server.lock.release ()
+            if not outstanding:
+                break
+            if not spool and not notices.unfinished_tasks:
+                break
+            time.sleep (0.05)
+        finished = time.time ()
+        stop.set ()
+        confirming.join ()
+        cleaning.join ()
+    finally:
+        for helper in helpers:
+            try:
+                os.kill (helper.pid, 15)
+                helper.wait ()
+            except OSError:
+                pass
+        shutil.rmtree (scratch, ignore_errors=1)
+
+    server.lock.acquire ()
+    double = 0
+    for times in server.confirmed.values ():
+        if times > 1:
+            double = double + times - 1
+    lost = []
+    for (token, (when, reply)) in server.tokens.items ():
+        if not server.confirmed.has_key (reply):
+            lost.append (token)
+    server.lock.release ()
+
+    results = {
+        'stress.mail' : percentiles (sending.times),
+        'stress.confirm' : percentiles (confirming.times),
+        'stress.clean' : percentiles (cleaning.times),
+        'stress.loop' : percentiles (server.loop_times),
+    }
+    summary = {
+        'messages' : count,
+        'signed' : len (server.tokens),
+        'unsigned' : server.unsigned,
+        'notices' : len (confirming.times),
+        'confirmed' : len (server.confirmed),
+        'double_confirmations' : double,
+        'lost_tokens' : len (lost),
+        'stray_confirmations' : server.stray,
+        'forged_notices' : len (server.forged),
+        'forged_confirmations' : server.forged_confirmed,
+        'send_rate' : count / max (sent - start, 1e-9),
+        'confirm_rate' : len (server.loop_times) / max (finished - start,
+            1e-9),
+        'mail_codes' : sending.codes,
+        'confirm_codes' : confirming.codes,
+        'clean_codes' : cleaning.codes,
+        'clean_runs' : len (cleaning.times),
+    }
+
+    sys.stderr.write ('%d messages sent in %.2f s (%.1f/s), %d signed, '
+        '%d unsigned\n' % (count, sent - start, summary['send_rate'],
+        summary['signed'], summary['unsigned']))
+    sys.stderr.write ('%d notices handled, %d confirmed (%.1f/s), '
+        '%d pymsgauth-clean runs\n' % (summary['notices'],
+        summary['confirmed'], summary['confirm_rate'], summary['clean_runs']))
+    for name in ('stress.mail', 'stress.confirm', 'stress.clean',
+            'stress.loop'):
+        r = results[name]
+        if r['repeat']:
+            sys.stderr.write ('%-16s %6d  median %8.2f ms  90%% %8.2f  '
+                '99%% %8.2f  max %8.2f\n' % (name, r['repeat'],
+                r['median'] * 1000, r['p90'] * 1000, r['p99'] * 1000,
+                r['max'] * 1000))
+    sys.stderr.write ('exit codes:  mail %s, confirm %s, clean %s\n'
+        % (sending.codes, confirming.codes, cleaning.codes))
+    sys.stderr.write ('double confirmations:  %d, lost tokens:  %d, '
+        'stray confirmations:  %d\n' % (double, len (lost), server.stray))
+    sys.stderr.write ('forged notices:  %d, answered:  %d\n'
+        % (len (server.forged), server.forged_confirmed))
+    errors = sending.errors + confirming.errors + cleaning.errors
+    for err in errors[:5]:
+        sys.stderr.write ('error output:  %s\n' % err)
+
+    report = {
+        'revision' : bench.revision (),
+        'python' : sys.version.split ()[0],
+        'date' : time.strftime ('%Y-%m-%dT%H:%M:%SZ', time.gmtime ()),
+        'results' : results,
+        'summary' : summary,
+    }
+    if output:
+        f = open (output, 'w')
+    else:
+        f = sys.stdout
+    json.dump (report, f, indent=1, sort_keys=1)
+    f.write ('\n')
+    failed = 0
+    for codes, ok in ((sending.codes, (0,)), (confirming.codes, (0, 99)),
+            (cleaning.codes, (0,))):
+        for code in codes.keys ():
+            if code not in ok:
+                failed = 1
+    if double or lost or server.stray or server.unsigned \
+            or server.forged_confirmed or failed:
+        sys.exit (1)
+
+if __name__ == '__main__':
+    main ()
@@ -27,14 +27,16 @@ __author__ = 'Charles Cazabon <software @ discworld.dyndns.org>'
 # Imports
 #
 
+# Only what every run needs is imported here; the rest is imported where it
+# is used, so runs that exit early (most deliveries to pymsgauth-confirm are
+# not qsecretary notices) do not pay for it.
 import sys
 import os
+import errno
+import stat
 import string
-import rfc822
-import cStringIO
+import thread
 import time
-import types
-import ConfParser
 
 #
 # Configuration constants
@@ -97,6 +99,17 @@ defaults = {
     # Log to file?  Will be expanded for leading user (i.e. '~/logfile')
     'log_file' : None,
 
+    # Log to syslog?  Set to the facility name (i.e. 'mail')
+    'log_syslog' : None,
+
+    # Log to a Unix datagram socket?  Set to its path; lines are sent in
+    # syslog format
+    'log_socket' : None,
+
+    # Log lines are buffered, and written out at exit, when a FATAL line is
+    # logged, or at least this often (in seconds) while logging continues
+    'log_flush_interval' : 5,
+
     # Default configuration/data directory; override this with the
     # PYMSGAUTH_DIR environment variable
     'pymsgauth_dir' : os.path.expanduser ('~/.pymsgauth'),
@@ -104,55 +117,370 @@ defaults = {
     # Configuration file name; will be looked for in the directory specifed
     # above.
     'pymsgauthrc_filename' : 'pymsgauthrc',
+
+    # How outstanding tokens are recorded.  'dotfile' keeps one empty file
+    # per token in the configuration/data directory; 'dbm' keeps them all in
+    # a single indexed database file, which scales much better when many
+    # tokens are outstanding.
+    'token_store' : 'dotfile',
+
+    # Database file name for the 'dbm' token store; will be created in the
+    # configuration/data directory.
+    'token_db_filename' : 'tokens.db',
+
+    # Width, in seconds, of the creation-time buckets used by the 'bucketed'
+    # token store.  Expired tokens are removed a whole bucket at a time, so a
+    # token may outlive token_lifetime by up to this much.
+    'token_bucket_seconds' : 86400,
+
+    # Expired tokens can be removed a batch at a time:  each pymsgauth-clean
+    # run examines at most clean_batch tokens (0 for all) and stops after
+    # clean_time_budget seconds (0 for no limit), carrying on from where the
+    # previous run stopped.  If clean_interval is set, sending signed mail
+    # also runs such a batch (of clean_batch, or 100, tokens) when none has
+    # run for that many seconds, so pymsgauth-clean need not be run at all.
+    'clean_batch' : 0,
+    'clean_time_budget' : 0,
+    'clean_interval' : 0,
+
+    # Number of notices pymsgauth-confirm handles at once when processing a
+    # Maildir or mbox, and of confirmations pymsgauth-flush sends at once;
+    # each one may be waiting on its own mail_prog.
+    'confirm_workers' : 1,
+
+    # Queue confirmations instead of sending them while the notice waits?
+    # Set to a directory (relative to the configuration/data directory) and
+    # pymsgauth-confirm writes each confirmation there and drops the notice
+    # at once; pymsgauth-flush sends them.  One which cannot be sent is
+    # retried after confirm_retry_interval seconds, doubling each time up to
+    # confirm_retry_max_interval, until it is confirm_retry_lifetime seconds
+    # old.
+    'confirm_spool' : None,
+    'confirm_retry_interval' : 60,
+    'confirm_retry_max_interval' : 3600,
+    'confirm_retry_lifetime' : 86400,
+
+    # Recently sent confirmations are remembered (up to confirm_memory_size
+    # of them, for token_lifetime), so a duplicate notice is dropped instead
+    # of delivered, and one redelivered after its confirmation could not be
+    # sent is answered again.  Set to 0 to forget them.  Spooled
+    # confirmations are held for confirm_coalesce_window seconds, and those
+    # for the same address are sent once.
+    'confirm_memory_size' : 1000,
+    'confirm_coalesce_window' : 0,
+
+    # Seconds to let mail_prog run before killing it (0 for no limit).  A
+    # timed-out delivery exits 111, so qmail will retry it later.
+    'mail_timeout' : 600,
+
+    # How to hand mail to qmail.  'inject' runs mail_prog for each message;
+    # 'qmqp' or 'smtp' submit it over the network to submission_host (on
+    # submission_port, or the protocol's standard port if 0), reusing SMTP
+    # connections between the messages one process sends.  Messages whose
+    # recipients qmail-inject would take from the header, and any sent while
+    # the server is unreachable, still go through mail_prog.
+    'submission' : 'inject',
+    'submission_host' : '127.0.0.1',
+    'submission_port' : 0,
+
+    # When pymsgauth-mail passes a message through unsigned and its input is
+    # a regular file, replace pymsgauth with mail_prog, reading the input
+    # directly, instead of copying the message to it.  mail_timeout is then
+    # enforced with an alarm signal, and mail_prog's output and exit code
+    # reach the caller unchanged.  Set to 0 to always copy the message.
+    'passthrough_exec' : 1,
+
+    # Token format.  'random' tokens are recorded in the token store when a
+    # message is sent.  'hmac' tokens carry their issue time and are signed
+    # with secret (which must be set), so sending writes nothing to disk; only
+    # confirming one records it, to stop replays.  Both kinds are accepted
+    # when confirming, whichever is configured.
+    'token_format' : 'random',
+
+    # Index each token by the Message-ID of the message it was sent with
+    # (and by a digest of its From, To, Cc, Subject and Date fields), so a
+    # notice quoting a message whose auth_field was stripped by a relay can
+    # still be confirmed.  Index entries expire along with the tokens.  Set
+    # to 0 to record only the tokens themselves (hmac tokens then write
+    # nothing to disk when sending).
+    'message_index' : 1,
+
+    # Record timings and counters?  Lines are written in statsd format
+    # ('name:value|ms' or 'name:value|c') to stats_file (appended to; see
+    # pymsgauth-stats) and/or sent to stats_socket, either the path of a Unix
+    # datagram socket or 'host:port' for a statsd server over UDP.  Each name
+    # starts with stats_prefix.
+    'stats_file' : None,
+    'stats_socket' : None,
+    'stats_prefix' : 'pymsgauth',
+
+    # Profile pymsgauth-mail, pymsgauth-confirm and pymsgauth-clean?  Set to
+    # a directory (or set the PYMSGAUTH_PROFILE environment variable) and
+    # each run writes its cProfile data and resource usage there, keeping
+    # the newest profile_max_files runs; pymsgauth-profile merges them into
+    # one report.  With profile_memory (or PYMSGAUTH_PROFILE_MEMORY) set,
+    # the objects each run leaves behind are counted too, which is slow.
+    'profile_dir' : None,
+    'profile_max_files' : 200,
+    'profile_memory' : 0,
+
+    # Limits for a shared pymsgauth-daemon (-m), read from its own
+    # configuration file:  how many users' configurations to keep loaded,
+    # how many requests one user may have running at once, and the CPU
+    # seconds and memory (in megabytes) each request may use (0 for no
+    # limit).
+    'tenant_cache_size' : 1000,
+    'tenant_process_limit' : 4,
+    'tenant_cpu_limit' : 60,
+    'tenant_memory_limit' : 256,
 }
 
+# Options whose values are converted when read from the configuration file
+integer_options = ('token_lifetime', 'log_stderr', 'token_bucket_seconds',
+    'confirm_workers', 'mail_timeout', 'submission_port',
+    'log_flush_interval', 'passthrough_exec', 'tenant_cache_size',
+    'tenant_process_limit', 'tenant_cpu_limit', 'tenant_memory_limit',
+    'clean_batch', 'clean_time_budget', 'clean_interval',
+    'confirm_retry_interval', 'confirm_retry_max_interval',
+    'confirm_retry_lifetime', 'confirm_memory_size',
+    'confirm_coalesce_window', 'profile_max_files', 'profile_memory',
+    'message_index')
+list_options = ('mail_prog', 'extra_mail_args', 'confirm_domain',
+    'token_recipient')
+
+# Suffix added to the configuration file name for its compiled cache
+config_cache_suffix = '.cache'
+
+# Version of the way parse_config_file () converts values.  A cache is only
+# used if it was written with the same version and the same integer_options
+# and list_options, so bump this whenever the conversion changes otherwise.
+config_cache_format = 1
+
+# File in the configuration/data directory recording where the last batch
+# of token expiry stopped
+sweep_cursor_filename = 'sweep-cursor'
+
+# Tokens examined by each batch run when sending mail, if clean_batch is 0
+sweep_send_batch = 100
+
+# File in the configuration/data directory recording recent confirmations
+recent_confirmations_filename = 'recent-confirmations'
+
+# Notices pymsgauth-confirm confirms from a Maildir or mbox between commits
+# of their spooled confirmations
+spool_commit_batch = 100
+
+# Line in qsecretary notices preceding the quoted original message
+qsecretary_separator = '--- Below this line is the top of your message.\n'
+
+# Seconds between SIGTERM and SIGKILL for a mail command past its timeout
+mail_kill_grace = 5
+
+# Seconds a daemon waits for a client it refuses to finish sending
+refuse_timeout = 5
+
+# Length of an hmac token:  'h', issue time and nonce (8 hex digits each),
+# and the hex HMAC-SHA1 digest
+hmac_token_length = 57
+
+# First character of the keys indexing tokens by message, which no token
+# starts with
+index_key_prefix = 'm'
+
+# Header fields digested to index a message by, besides its Message-ID
+index_fields = ('from', 'to', 'cc', 'subject', 'date')
+
+# Size of the pieces messages are copied in
+io_chunk_size = 65536
+
+# qmail's control directory, read for the host qmail-inject puts in the
+# envelope sender when it is not given one
+qmail_control_dir = '/var/qmail/control'
+
+# Header fields qmail-inject removes from the messages it queues
+inject_removed_fields = ('bcc', 'resent-bcc')
+
+# Results of handling a possible qsecretary notice
+(CONFIRMED, IGNORED, UNMATCHED, FAILED, DUPLICATE) = range (5)
+
 # Configuration data held here.
 config = {}
 
-# Components of stack trace (indices to tuple)
-FILENAME, LINENO, FUNCNAME = 0, 1, 2        #SOURCELINE = 3 ; not used
-
 # Open logging file
 logfd = None
 
+# Log lines waiting to be written, as (level, timestamp, text) tuples, the
+# lock protecting the buffer, and when it was last flushed
+log_buffer = []
+log_lock = thread.allocate_lock ()
+log_flushed = time.time ()
+log_flush_registered = 0
+
+# Flush buffered log lines when this many are waiting
+log_buffer_lines = 100
+
+# Timestamp cache:  the second last formatted, and its text
+log_second = None
+log_second_text = ''
+
+# Open syslog / datagram socket sinks
+log_syslog_open = 0
+log_sock = None
+
+# Syslog priorities for our logging levels
+syslog_priorities = {
+    TRACE : 7, DEBUG : 7, INFO : 6, WARN : 4, ERROR : 3, FATAL : 2,
+}
+
+# Statistics lines waiting to be written, whether they are being collected
+# (set when the configuration is read), and the open stats socket
+stats_buffer = []
+stats_enabled = 0
+stats_flush_registered = 0
+stats_sock = None
+
+# Profile being recorded by start_profile (), if any
+profile_capture = None
+
+# Counter names for the results of handling a possible qsecretary notice
+result_names = {
+    CONFIRMED : 'confirmed', IGNORED : 'ignored', UNMATCHED : 'unmatched',
+    FAILED : 'failed', DUPLICATE : 'duplicate',
+}
+
+# Identity (path, mtime, size, inode) of the configuration file last read
+# into config; long-running processes only re-read it when this changes.
+config_stamp = None
+
+# Modules pymsgauth-daemon imports before serving, so request handlers do
+# not each import them (and can, after switching to an unprivileged user)
+daemon_modules = ('rfc822', 'cStringIO', 'subprocess', 'select', 'signal',
+    'fcntl', 'sha', 'hmac', 'anydbm', 'marshal', 'ConfParser', 'atexit',
+    'traceback', 'shutil', 'smtplib', 'syslog', 'resource', 'copy')
+
+# Shared daemon state:  configuration snapshots by user data directory, as
+# [last use, snapshot] lists; the running request handlers, by process id,
+# as (user id, user data directory, configuration report pipe); and the
+# number each user has running
+tenant_configs = {}
+tenant_uses = 0
+tenant_children = {}
+tenant_running = {}
+
+# Largest configuration report a shared daemon's request handler sends back
+# for the daemon to cache; it must fit in a pipe without blocking
+tenant_report_limit = 65536
+
 #############################
 class pymsgauthError (StandardError):
     pass
 
 #############################
 class DeliveryError (pymsgauthError):
-    pass
+    def __init__ (self, msg, exitcode=1):
+        pymsgauthError.__init__ (self, msg)
+        # Exit code to pass on to our caller
+        self.exitcode = exitcode or 1
 
 #############################
 class ConfigurationError (pymsgauthError):
     pass
 
+#############################
+class NotSubmitted (pymsgauthError):
+    '''Raised by a submitter when none of the message reached the server,
+    so it can safely be sent another way.
+    '''
+    pass
+
 #######################################
-def log (level=INFO, msg=''):
-    global logfd
+def log (level=INFO, msg='', *args):
+    '''Log msg at level.  If args are given, msg is a format string for
+    them; it is only formatted if the line will actually be logged.  Lines
+    are buffered, and written out by flush_log ().
+    '''
+    global log_second, log_second_text, log_flush_registered
     if level < config['log_level']:
         return
+    if args:
+        msg = msg % args
     if level == TRACE:
-        import traceback
-        trace = traceback.extract_stack ()[-2]
-        s = '%s() [%s:%i] %s\n' % (trace[FUNCNAME],
-            os.path.split (trace[FILENAME])[-1],
-            trace[LINENO], msg)
-    else:
-        s = msg + '\n'
+        frame = sys._getframe (1)
+        msg = '%s() [%s:%i] %s' % (frame.f_code.co_name,
+            os.path.split (frame.f_code.co_filename)[-1], frame.f_lineno, msg)
+    now = time.time ()
+    if int (now) != log_second:
+        log_second = int (now)
+        log_second_text = time.strftime ('%d %b %Y %H:%M:%S',
+            time.localtime (now))
+    if config['log_file'] and not logfd:
+        open_log_file ()
+    log_lock.acquire ()
+    try:
+        if not log_flush_registered:
+            import atexit
+            atexit.register (flush_log)
+            log_flush_registered = 1
+        log_buffer.append ((level, log_second_text, msg + '\n'))
+        pending = len (log_buffer)
+    finally:
+        log_lock.release ()
+    if level >= FATAL or pending >= log_buffer_lines \
+            or now - log_flushed >= config['log_flush_interval']:
+        flush_log ()
+
+#############################
+def open_log_file ():
+    global logfd
+    try:
+        logfd = open (os.path.expanduser (config['log_file']), 'a')
+    except IOError, txt:
+        raise ConfigurationError, 'failed to open log file %s (%s)' \
+            % (config['log_file'], txt)
+
+#############################
+def flush_log ():
+    '''Write out buffered log lines to stderr, the log file, syslog and the
+    log socket, as configured.
+    '''
+    global log_flushed, log_syslog_open, log_sock
+    log_lock.acquire ()
+    try:
+        lines = log_buffer[:]
+        del log_buffer[:]
+        log_flushed = time.time ()
+    finally:
+        log_lock.release ()
+    if not lines:
+        return
     if config['log_stderr']:
-        sys.stderr.write (s)
+        sys.stderr.write (string.join (map (lambda l: l[2], lines), ''))
         sys.stderr.flush ()
-    if config['log_file']:
-        if not logfd:
-            try:
-                logfd = open (os.path.expanduser (config['log_file']), 'a')
-            except IOError, txt:
-                raise ConfigurationError, 'failed to open log file %s (%s)' \
-                    % (config['log_file'], txt)
-        t = time.localtime (time.time ())
-        logfd.write ('%s %s' % (time.strftime ('%d %b %Y %H:%M:%S', t), s))
+    if logfd:
+        logfd.write (string.join (
+            map (lambda l: '%s %s' % (l[1], l[2]), lines), ''))
         logfd.flush ()
+    if config['log_syslog']:
+        import syslog
+        if not log_syslog_open:
+            facility = getattr (syslog, 'LOG_' + string.upper (
+                config['log_syslog']), syslog.LOG_MAIL)
+            syslog.openlog ('pymsgauth', syslog.LOG_PID, facility)
+            log_syslog_open = 1
+        for (level, stamp, text) in lines:
+            syslog.syslog (syslog_priorities[level], text[:-1])
+    if config['log_socket']:
+        import socket
+        try:
+            if not log_sock:
+                log_sock = socket.socket (socket.AF_UNIX, socket.SOCK_DGRAM)
+            for (level, stamp, text) in lines:
+                log_sock.sendto ('<%i>pymsgauth[%i]: %s'
+                    % (syslog_priorities[level], os.getpid (), text),
+                    config['log_socket'])
+        except socket.error:
+            # Nobody listening; logging must not break mail handling
+            pass
 
 #############################
 def log_exception ():
@@ -163,14 +491,430 @@ def log_exception ():
     for line in lines:
         log (FATAL, line[:-1])
 
+#############################
+def stats_timing (name, start):
+    '''Record the time since start (a time.time () value) as a timing for
+    name.  Does nothing unless statistics are enabled.
+    '''
+    if stats_enabled:
+        stats_buffer.append ('%s.%s:%.3f|ms\n' % (config['stats_prefix'],
+            name, (time.time () - start) * 1000.0))
+
+#############################
+def stats_count (name):
+    if stats_enabled:
+        stats_buffer.append ('%s.%s:1|c\n' % (config['stats_prefix'], name))
+
+#############################
+def flush_stats ():
+    '''Write out recorded statistics to the stats file and socket.
+    '''
+    global stats_sock
+    lines = stats_buffer[:]
+    del stats_buffer[:len (lines)]
+    if not lines:
+        return
+    if config['stats_file']:
+        # One write, so concurrent processes' lines are not interleaved
+        try:
+            fd = os.open (os.path.expanduser (config['stats_file']),
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+            try:
+                os.write (fd, string.join (lines, ''))
+            finally:
+                os.close (fd)
+        except OSError, txt:
+            log (WARN, 'Warning:  failed writing stats file %s (%s)',
+                config['stats_file'], txt)
+    if config['stats_socket']:
+        import socket
+        dest = config['stats_socket']
+        try:
+            if dest[:1] == '/':
+                family = socket.AF_UNIX
+            else:
+                family = socket.AF_INET
+                host, port = string.split (dest, ':', 1)
+                dest = (host, int (port))
+            if not stats_sock:
+                stats_sock = socket.socket (family, socket.SOCK_DGRAM)
+            # statsd takes several lines per datagram; keep them small
+            for i in range (0, len (lines), 20):
+                stats_sock.sendto (string.join (lines[i:i + 20], ''), dest)
+        except (socket.error, ValueError), txt:
+            # Nobody listening; statistics must not break mail handling
+            pass
+
+#############################
+def summarize_stats (args):
+    '''Print a summary of the statsd-format files named in args (default:
+    the configured stats_file):  totals for counters, and count,
+    percentiles and a histogram for timings.
+    '''
+    read_config ()
+    if not args:
+        if not config['stats_file']:
+            sys.stderr.write ('usage:  pymsgauth-stats [stats-file ...]\n')
+            sys.exit (100)
+        args = [os.path.expanduser (config['stats_file'])]
+    counters = {}
+    timings = {}
+    for path in args:
+        try:
+            f = open (path)
+        except IOError, txt:
+            sys.stderr.write ('pymsgauth-stats:  %s\n' % txt)
+            sys.exit (111)
+        for line in f.xreadlines ():
+            try:
+                name, rest = string.split (string.strip (line), ':', 1)
+                value, kind = string.split (rest, '|', 1)
+                value = float (value)
+            except ValueError:
+                continue
+            if kind == 'c':
+                counters[name] = counters.get (name, 0) + value
+            elif kind == 'ms':
+                timings.setdefault (name, []).append (value)
+        f.close ()
+
+    names = counters.keys ()
+    names.sort ()
+    for name in names:
+        sys.stdout.write ('%-40s %10d\n' % (name, counters[name]))
+    names = timings.keys ()
+    names.sort ()
+    for name in names:
+        values = timings[name]
+        values.sort ()
+        def pct (p, values=values):
+            return values[min (len (values) - 1, int (len (values) * p))]
+        sys.stdout.write ('%s:  %d, mean %.3f ms, 50%% %.3f, 90%% %.3f, '
+            '99%% %.3f, max %.3f\n' % (name, len (values),
+            reduce (lambda a, b: a + b, values) / len (values), pct (0.5),
+            pct (0.9), pct (0.99), values[-1]))
+        # Histogram, in power-of-two millisecond buckets
+        buckets = {}
+        for value in values:
+            bound = 0.125
+            while value > bound:
+                bound = bound * 2
+            buckets[bound] = buckets.get (bound, 0) + 1
+        bounds = buckets.keys ()
+        bounds.sort ()
+        most = max (buckets.values ())
+        for bound in bounds:
+            sys.stdout.write ('    <= %10.3f ms %8d %s\n' % (bound,
+                buckets[bound], '#' * ((buckets[bound] * 50 + most - 1)
+                / most)))
+
+#############################
+def get_profile_dir ():
+    '''Return the directory profiles are written to:  PYMSGAUTH_PROFILE if
+    set, else profile_dir; None if profiling is off.
+    '''
+    path = os.environ.get ('PYMSGAUTH_PROFILE')
+    if not path:
+        if config_stamp is None:
+            # Not loaded yet.  The profiled function reads it again, and
+            # reports any error then; ConfParser's are not StandardErrors.
+            try:
+                read_config ()
+            except Exception:
+                return None
+        path = config.get ('profile_dir')
+    if not path:
+        return None
+    return os.path.expanduser (path)
+
+#############################
+def object_census ():
+    '''Return the number of objects tracked by the garbage collector, by
+    type name.
+    '''
+    import gc
+    gc.collect ()
+    counts = {}
+    for obj in gc.get_objects ():
+        try:
+            name = obj.__class__.__name__
+        except AttributeError:
+            name = type (obj).__name__
+        counts[name] = counts.get (name, 0) + 1
+    return counts
+
+#############################
+def start_profile (path, name):
+    '''Start recording a profile of this invocation, to be written to
+    directory path by finish_profile ().
+    '''
+    global profile_capture
+    import cProfile
+    import resource
+    capture = {
+        'path' : path,
+        'name' : name,
+        'start' : time.time (),
+        'rusage' : resource.getrusage (resource.RUSAGE_SELF),
+    }
+    if config.get ('profile_memory') \
+            or os.environ.get ('PYMSGAUTH_PROFILE_MEMORY'):
+        capture['objects'] = object_census ()
+    capture['profiler'] = cProfile.Profile ()
+    profile_capture = capture
+    capture['profiler'].enable ()
+
+#############################
+def finish_profile ():
+    '''Stop recording and write the profile started by start_profile (), as
+    <name>.<milliseconds>.<pid>.prof (cProfile data) and .usage (marshalled
+    resource usage and, with profile_memory, object counts gained), then
+    remove the oldest captures beyond profile_max_files.  Errors are
+    logged, not raised.
+    '''
+    global profile_capture
+    capture = profile_capture
+    if capture is None:
+        return
+    profile_capture = None
+    capture['profiler'].disable ()
+    import resource
+    import marshal
+    before = capture['rusage']
+    after = resource.getrusage (resource.RUSAGE_SELF)
+    usage = {
+        'name' : capture['name'],
+        'elapsed' : time.time () - capture['start'],
+        'utime' : after.ru_utime - before.ru_utime,
+        'stime' : after.ru_stime - before.ru_stime,
+        # Peak for the process, in kilobytes
+        'maxrss' : after.ru_maxrss,
+        'minflt' : after.ru_minflt - before.ru_minflt,
+        'majflt' : after.ru_majflt - before.ru_majflt,
+        'inblock' : after.ru_inblock - before.ru_inblock,
+        'oublock' : after.ru_oublock - before.ru_oublock,
+    }
+    if capture.has_key ('objects'):
+        gained = {}
+        counts = object_census ()
+        for (name, count) in counts.items ():
+            change = count - capture['objects'].get (name, 0)
+            if change:
+                gained[name] = change
+        usage['objects'] = gained
+    path = capture['path']
+    base = os.path.join (path, '%s.%d.%d' % (capture['name'],
+        capture['start'] * 1000, os.getpid ()))
+    try:
+        if not os.path.isdir (path):
+            os.makedirs (path, 0700)
+        capture['profiler'].dump_stats (base + '.prof')
+        f = open (base + '.usage', 'wb')
+        marshal.dump (usage, f)
+        f.close ()
+        prune_profiles (path, config.get ('profile_max_files',
+            defaults['profile_max_files']))
+    except (IOError, OSError), txt:
+        log (WARN, 'Warning:  failed writing profile %s (%s)', base, txt)
+
+#############################
+def prune_profiles (path, keep):
+    '''Remove all but the newest keep captures in directory path.
+    '''
+    captures = {}
+    for filename in os.listdir (path):
+        base, ext = os.path.splitext (filename)
+        parts = string.split (base, '.')
+        if ext not in ('.prof', '.usage') or len (parts) != 3:
+            continue
+        try:
+            captures[(int (parts[1]), base)] = 1
+        except ValueError:
+            continue
+    captures = captures.keys ()
+    captures.sort ()
+    if keep <= 0:
+        return
+    for (started, base) in captures[:-keep]:
+        for ext in ('.prof', '.usage'):
+            try:
+                os.unlink (os.path.join (path, base + ext))
+            except OSError:
+                pass
+
+#############################
+def profiled (name, func):
+    '''Return func wrapped to record a profile of each call as name, when
+    profiling is on (see get_profile_dir ()).
+    '''
+    def wrapper (*args):
+        path = get_profile_dir ()
+        if path is None or profile_capture is not None:
+            return func (*args)
+        start_profile (path, name)
+        try:
+            return func (*args)
+        finally:
+            finish_profile ()
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+#############################
+def profile_report (args):
+    '''Print the hot spots in the profiles named in args (directories, or
+    .prof files), merged, and a summary of their resource usage and object
+    counts.  With -k, only captures whose name starts with that; -n, the
+    number of functions and object types listed (default 30); -s, the
+    pstats sort order (default cumulative).  Without arguments, reads the
+    profile directory configured.
+    '''
+    import getopt
+    usage = 'usage:  pymsgauth-profile [-k name] [-n lines] [-s sort] ' \
+        '[directory|file.prof ...]\n'
+    try:
+        opts, args = getopt.getopt (args, 'k:n:s:')
+        prefix = ''
+        lines = 30
+        sort = 'cumulative'
+        for (opt, value) in opts:
+            if opt == '-k':
+                prefix = value
+            elif opt == '-n':
+                lines = int (value)
+            elif opt == '-s':
+                sort = value
+    except (getopt.GetoptError, ValueError):
+        sys.stderr.write (usage)
+        sys.exit (100)
+    if not args:
+        path = get_profile_dir ()
+        if path is None:
+            sys.stderr.write (usage)
+            sys.exit (100)
+        args = [path]
+
+    files = []
+    for arg in args:
+        if os.path.isdir (arg):
+            for filename in os.listdir (arg):
+                if filename[:len (prefix)] == prefix \
+                        and filename[-5:] == '.prof':
+                    files.append (os.path.join (arg, filename))
+        else:
+            files.append (arg)
+    if not files:
+        sys.stderr.write ('pymsgauth-profile:  no profiles found\n')
+        sys.exit (111)
+    files.sort ()
+
+    import pstats
+    import marshal
+    try:
+        stats = pstats.Stats (files[0], stream=sys.stdout)
+        for filename in files[1:]:
+            stats.add (filename)
+    except (IOError, EOFError, ValueError, TypeError), txt:
+        sys.stderr.write ('pymsgauth-profile:  %s\n' % txt)
+        sys.exit (111)
+    sys.stdout.write ('%d profiles\n' % len (files))
+    # Otherwise print_stats () lists every file
+    stats.files = []
+    stats.strip_dirs ()
+    try:
+        stats.sort_stats (sort)
+    except KeyError:
+        sys.stderr.write (usage)
+        sys.exit (100)
+    stats.print_stats (lines)
+
+    # Resource usage by capture name, and object counts gained overall
+    totals = {}
+    objects = {}
+    for filename in files:
+        try:
+            f = open (filename[:-5] + '.usage', 'rb')
+            usage = marshal.load (f)
+            f.close ()
+        except (IOError, EOFError, ValueError, TypeError):
+            continue
+        total = totals.setdefault (usage['name'], {'count' : 0,
+            'maxrss' : 0})
+        total['count'] = total['count'] + 1
+        for key in ('elapsed', 'utime', 'stime', 'minflt', 'majflt',
+                'inblock', 'oublock'):
+            total[key] = total.get (key, 0) + usage[key]
+        total['maxrss'] = max (total['maxrss'], usage['maxrss'])
+        for (name, change) in usage.get ('objects', {}).items ():
+            objects[name] = objects.get (name, 0) + change
+    names = totals.keys ()
+    names.sort ()
+    for name in names:
+        total = totals[name]
+        count = float (total['count'])
+        sys.stdout.write ('%s:  %d runs, mean %.3f ms elapsed, %.3f ms user, '
+            '%.3f ms system, %.1f minor and %.1f major faults, %.1f blocks '
+            'in, %.1f out; peak %d KB\n' % (name, total['count'],
+            total['elapsed'] * 1000 / count, total['utime'] * 1000 / count,
+            total['stime'] * 1000 / count, total['minflt'] / count,
+            total['majflt'] / count, total['inblock'] / count,
+            total['oublock'] / count, total['maxrss']))
+    if objects:
+        sys.stdout.write ('\nObjects gained (all runs), by type:\n')
+        ranked = map (lambda (name, change): (-change, name), objects.items ())
+        ranked.sort ()
+        for (change, name) in ranked[:lines]:
+            sys.stdout.write ('%10d  %s\n' % (-change, name))
+
+#############################
+def config_file_stamp (config_file):
+    try:
+        s = os.stat (config_file)
+    except OSError:
+        return None
+    return (config_file, s.st_mtime, s[stat.ST_SIZE], s[stat.ST_INO])
+
 #############################
 def read_config ():
-    config.update (defaults)
-    config['pymsgauth_dir'] = os.environ.get ('PYMSGAUTH_DIR',
+    global config_stamp, stats_enabled, stats_flush_registered
+    start = time.time ()
+    pymsgauth_dir = os.environ.get ('PYMSGAUTH_DIR',
         defaults['pymsgauth_dir'])
-    config_file = os.path.join (config['pymsgauth_dir'],
+    config_file = os.path.join (pymsgauth_dir,
         defaults['pymsgauthrc_filename'])
-    log (TRACE, 'config_file == %s' % config_file)
+    stamp = config_file_stamp (config_file)
+    if stamp and stamp == config_stamp:
+        # Already loaded and unchanged
+        return
+    config_stamp = None
+    config.update (defaults)
+    config['pymsgauth_dir'] = pymsgauth_dir
+    log (TRACE, 'config_file == %s', config_file)
+    options = read_config_cache (config_file, stamp)
+    if options is None:
+        options = parse_config_file (config_file)
+        write_config_cache (config_file, stamp, options)
+    config.update (options)
+    matchers.clear ()
+    for option in list_options:
+        if type (config[option]) != type ([]):
+            config[option] = [config[option]]
+    config_stamp = stamp
+    stats_enabled = config['stats_file'] or config['stats_socket']
+    if stats_enabled and not stats_flush_registered:
+        import atexit
+        atexit.register (flush_stats)
+        stats_flush_registered = 1
+    stats_timing ('config_load', start)
+    log (TRACE)
+
+#############################
+def parse_config_file (config_file):
+    '''Parse config_file, returning a dictionary of the options it sets,
+    converted to their internal types.
+    '''
+    import ConfParser
+    options = {}
     conf = ConfParser.ConfParser ()
     log (TRACE)
     try:
@@ -184,281 +928,2838 @@ def read_config ():
                 except KeyError:
                     raise ConfigurationError, \
                         '"%s" not a valid logging level' % value
-            config[option] = value
+            elif option in integer_options:
+                try:
+                    value = int (value)
+                except (TypeError, ValueError):
+                    raise ConfigurationError, \
+                        '"%s" not a valid integer for %s' % (value, option)
+            config[option] = options[option] = value
             if option == 'secret':
-                log (TRACE, 'option secret == %s...' % value[:20])
+                log (TRACE, 'option secret == %s...', value[:20])
             else:
-                log (TRACE, 'option %s == %s...' % (option, config[option]))
+                log (TRACE, 'option %s == %s...', option, config[option])
     except (ConfigurationError, ConfParser.ConfParserException), txt:
-        log (FATAL, 'Fatal:  exception reading %s (%s)' % (config_file, txt))
+        log (FATAL, 'Fatal:  exception reading %s (%s)', config_file, txt)
         raise
-    if type (config['token_recipient']) != types.ListType:
-        config['token_recipient'] = [config['token_recipient']]
-    log (TRACE)
+    return options
 
 #############################
-def extract_original_message (msg):
-    msg.rewindbody ()
-    lines = []
-    while 1:
-        lines.append (msg.fp.readline())
-        if lines[-1] == '':
-            del lines[-1]
-            break
-
-    # Strip qsecretary text
-    found_separator = 0
-    while lines and not found_separator:
-        if lines[0] == '--- Below this line is the top of your message.\n':
-            found_separator = 1
-        del lines[0]
-
-    # Strip blank line(s)
-    while lines and string.strip (lines[0]) == '':
-        del lines[0]
-
-    buf = cStringIO.StringIO (string.join (lines, ''))
-    buf.seek (0)
-    orig_msg = rfc822.Message (buf)
-    return orig_msg
+def read_config_cache (config_file, stamp):
+    '''Return the options stored in the compiled cache of config_file, or
+    None if there is no cache or it does not match the file's current stamp.
+    '''
+    import marshal
+    if not stamp:
+        return None
+    try:
+        # Anything but a regular file (a FIFO, say) is not a cache
+        fd = os.open (config_file + config_cache_suffix,
+            os.O_RDONLY | os.O_NONBLOCK)
+        f = os.fdopen (fd, 'rb')
+        try:
+            if not stat.S_ISREG (os.fstat (fd)[stat.ST_MODE]):
+                return None
+            version, cached_stamp, options = marshal.load (f)
+        finally:
+            f.close ()
+    except (OSError, IOError, EOFError, ValueError, TypeError):
+        return None
+    if version != (config_cache_format, integer_options, list_options) \
+            or cached_stamp != stamp[1:]:
+        log (TRACE, 'stale configuration cache')
+        return None
+    log (TRACE, 'using configuration cache')
+    return options
 
 #############################
-def gen_token (msg):
-    import sha
-    lines = []
-    token = sha.new('%s,%s,%s,%s'
-        % (os.getpid(), time.time(), string.join (msg.headers),
-            config['secret'])).hexdigest()
-    # Record token
-    p = os.path.join (config['pymsgauth_dir'], '.%s' % token)
+def write_config_cache (config_file, stamp, options):
+    '''Atomically replace the compiled cache of config_file.  Failure is
+    not an error; the configuration file is just parsed again next time.
+    '''
+    import marshal
+    if not stamp:
+        return
+    cache_file = config_file + config_cache_suffix
+    tmp_file = '%s.%s' % (cache_file, os.getpid ())
     try:
-        open (p, 'wb')
-        log (TRACE, 'Recorded token %s.' % p)
-    except IOError, txt:
-        log (FATAL, 'Fatal:  exception creating %s (%s)' % (p, txt))
-        raise
-    return token
+        # The cache contains the secret, so keep it private
+        fd = os.open (tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        f = os.fdopen (fd, 'wb')
+        try:
+            marshal.dump (((config_cache_format, integer_options,
+                list_options), stamp[1:], options), f)
+        finally:
+            f.close ()
+        os.rename (tmp_file, cache_file)
+        log (TRACE, 'wrote configuration cache %s', cache_file)
+    except (IOError, OSError, ValueError), txt:
+        log (DEBUG, 'failed writing configuration cache %s (%s)',
+            cache_file, txt)
+        try:
+            os.unlink (tmp_file)
+        except OSError:
+            pass
 
 #############################
-def check_token (msg, token):
-    # Find existing token
-    p = os.path.join (config['pymsgauth_dir'], '.%s' % token)
-    if not os.path.exists (p):
-        return 0
-    if os.path.islink (p) or not os.path.isfile (p):
-        log (WARN, 'Warning:  %s is not a regular file, skipping...' % p)
-        return 0
-    try:
-        log (INFO, 'Matched token %s, removing.' % token)
-        os.unlink (p)
-        log (TRACE, 'Removed token %s.' % token)
-    except OSError, txt:
-        log (FATAL, 'Fatal:  error handling token %s (%s)' % (token, txt))
-        log_exception ()
-        # Exit 0 so qmail delivers the qsecretary notice to user
-        sys.exit (0)
-    return 1
+def read_header_block (fp):
+    '''Read lines from fp up to and including the blank line ending the
+    message header, and return them as a string.  fp is left positioned at
+    the start of the body.
+    '''
+    lines = []
+    while 1:
+        line = fp.readline ()
+        lines.append (line)
+        if line in ('', '\n', '\r\n'):
+            break
+    return string.join (lines, '')
 
 #############################
-def send_mail (msgbuf, mailcmd):
-    import popen2
-    popen2._cleanup()
-    log (TRACE, 'Mail command is "%s".' % mailcmd)
-    cmd = popen2.Popen3 (mailcmd, 1, bufsize=-1)
-    cmdout, cmdin, cmderr = cmd.fromchild, cmd.tochild, cmd.childerr
-    cmdin.write (msgbuf)
-    cmdin.flush ()
-    cmdin.close ()
-    log (TRACE)
+def extract_original_message (msg):
+    '''Return an rfc822.Message holding just the header of the original
+    message quoted in qsecretary notice msg.  The notice body is scanned
+    once, and reading stops at the end of the quoted header.
+    '''
+    if msg.seekable:
+        msg.rewindbody ()
+    fp = msg.fp
+
+    # Skip qsecretary text
+    while 1:
+        line = fp.readline ()
+        if not line or line == qsecretary_separator:
+            break
 
-    err = string.strip (cmderr.read ())
-    cmderr.close ()
-    out = string.strip (cmdout.read ())
-    cmdout.close ()
+    # Skip blank line(s)
+    line = fp.readline ()
+    while line and not string.strip (line):
+        line = fp.readline ()
 
-    r = cmd.wait ()
-    log (TRACE, 'r == %s' % r)
+    if line:
+        header = line + read_header_block (fp)
+    else:
+        header = ''
+    import rfc822
+    import cStringIO
+    return rfc822.Message (cStringIO.StringIO (header))
 
-    exitcode = 0
-    try:
-        if r:
-            if os.WIFEXITED (r):
-                exitcode = os.WEXITSTATUS (r)
-                if os.WIFSIGNALED (r):
-                    exitsignal = 'signal %s' % os.WTERMSIG (r)
-                else:
-                    exitsignal = 'no signal'
-                if err:
-                    errtext = ', err: "%s"' % err
-                else:
-                    errtext = ''
-                raise DeliveryError, 'mail command %s exited %s, %s%s' \
-                    % (mailcmd, exitcode, exitsignal, errtext)
-            else:
-                exitcode = 127
-                raise DeliveryError, 'mail command %s did not exit (rc == %s)' \
-                    % (mailcmd, r)
+#############################
+class DotfileTokenStore:
+    '''Token store keeping one empty file named .<token> per outstanding
+    token in the configuration/data directory.
+    '''
+    #############################
+    def __init__ (self, path):
+        self.path = path
 
-        if err:
-            raise DeliveryError, 'mail command %s error: "%s"' % (mailcmd, err)
-            exitcode = 1
+    #############################
+    def add (self, token, keys=()):
+        '''Record token, indexed by each of keys (see message_keys ()).
+        '''
+        p = os.path.join (self.path, '.%s' % token)
+        open (p, 'wb')
+        log (TRACE, 'Recorded token %s.', p)
+        self.index (token, keys)
 
-    except DeliveryError, txt:
-        log (FATAL, 'Fatal:  failed sending mail (%s)' % txt)
-        log_exception ()
-        sys.exit (exitcode or 1)
+    #############################
+    def index (self, token, keys):
+        '''Index token by each of keys, without recording the token itself.
+        Each entry is a dotfile too, so it expires along with the token.
+        '''
+        for key in keys:
+            write_index_file (os.path.join (self.path, '.%s' % key), token)
 
-    if out:
-        log (WARN, 'Warning:  command "%s" said "%s"' % (mailcmd, out))
+    #############################
+    def lookup (self, key):
+        '''Return the token indexed by key, or None.
+        '''
+        return read_index_file (os.path.join (self.path, '.%s' % key))
 
-    log (TRACE, 'Sent mail.')
+    #############################
+    def claim (self, token):
+        '''Remove token from the store.  Returns 1 if this call removed it,
+        0 if it was not present (or another process claimed it first).
+        '''
+        p = os.path.join (self.path, '.%s' % token)
+        try:
+            s = os.lstat (p)
+        except OSError, o:
+            if o.errno == errno.ENOENT:
+                return 0
+            raise
+        if not stat.S_ISREG (s[stat.ST_MODE]):
+            log (WARN, 'Warning:  %s is not a regular file, skipping...', p)
+            return 0
+        try:
+            os.unlink (p)
+        except OSError, o:
+            if o.errno == errno.ENOENT:
+                return 0
+            raise
+        return 1
 
-#############################
-def clean_old_tokens ():
-    try:
-        import stat
-        read_config ()
-        log (TRACE)
-        oldest = int (time.time()) - config['token_lifetime']
-        # Find existing token
-        files = os.listdir (config['pymsgauth_dir'])
-        for filename in files:
+    #############################
+    def mark_used (self, token, issued):
+        '''Record that stateless token has been used.  Returns 1 if this call
+        recorded it, 0 if it was already recorded.
+        '''
+        return create_exclusive (os.path.join (self.path, '.%s' % token))
+
+    #############################
+    def sweep (self, oldest, cursor='', limit=0, deadline=None):
+        '''Remove tokens created before oldest, in token order starting
+        after cursor, examining at most limit tokens (0 for all) and
+        stopping once time.time () passes deadline (if not None).  Returns
+        the number removed and the cursor to resume from ('' when the end
+        was reached).
+        '''
+        names = []
+        for filename in os.listdir (self.path):
             if filename[0] != '.':
                 # Not a token file, skip
-                log (TRACE, 'Ignoring file %s.' % filename)
-                continue
-            p = os.path.join (config['pymsgauth_dir'], filename)
-            if os.path.islink (p) or not os.path.isfile (p):
-                log (WARN, 'Warning:  %s is not a regular file, skipping...' % p)
-                continue
+                log (TRACE, 'Ignoring file %s.', filename)
+            elif filename > cursor:
+                names.append (filename)
+        names.sort ()
+        if limit and len (names) > limit:
+            del names[limit:]
+        else:
+            limit = 0
+        removed = 0
+        for filename in names:
+            if deadline is not None and time.time () >= deadline:
+                return removed, cursor
+            cursor = filename
+            p = os.path.join (self.path, filename)
             try:
                 s = os.lstat (p)
+                if not stat.S_ISREG (s[stat.ST_MODE]):
+                    log (WARN, 'Warning:  %s is not a regular file, '
+                        'skipping...', p)
+                    continue
                 if s[stat.ST_CTIME] < oldest:
-                    log (INFO, 'Removing old token %s.' % filename)
+                    log (INFO, 'Removing old token %s.', filename)
                     os.unlink (p)
+                    removed = removed + 1
             except OSError, txt:
-                log (ERROR, 'Error:  error handling token %s (%s)'
-                    % (filename, txt))
-                raise
+                # Claimed meanwhile, or a problem with just this file
+                if txt.errno != errno.ENOENT:
+                    log (ERROR, 'Error:  error handling token %s (%s)',
+                        filename, txt)
+        if limit:
+            # Stopped short of the end
+            return removed, cursor
+        return removed, ''
 
-    except StandardError, txt:
-        log (FATAL, 'Fatal:  caught exception (%s)' % txt)
-        log_exception ()
-        sys.exit (1)
+    #############################
+    def expire (self, oldest):
+        self.sweep (oldest)
 
 #############################
-def sendmail_wrapper (args):
-    try:
-        read_config ()
-        log (TRACE)
-        #mailcmd = (os.environ.get ('MAIL_PROG', config['mail_prog'])
-        #    + ' '
-        #    + config['extra_mail_args']
-        #    + ' '
-        #    + string.join (args))
-        mailcmd = config['mail_prog'][:]
-        if config['extra_mail_args']:
-            mailcmd += config['extra_mail_args']
-        mailcmd += args
-        log (TRACE, 'mailcmd == %s' % mailcmd)
-        buf = cStringIO.StringIO (sys.stdin.read())
-        msg = rfc822.Message (buf, seekable=1)
+class DbmTokenStore:
+    '''Token store keeping all outstanding tokens, with their creation
+    times, in a single dbm database.  Access is serialized with flock() on a
+    separate lock file.
+    '''
+    #############################
+    def __init__ (self, path):
+        self.filename = os.path.join (path, config['token_db_filename'])
 
-        sign_message = 0
-        for arg in args:
-            if arg in config['token_recipient']:
-                sign_message = 1
-                break
-        if not sign_message:
-            recips = []
-            for field in ('to', 'cc', 'bcc', 'resent-to', 'resent-cc', 'resent-bcc'):
-                recips.extend (msg.getaddrlist (field))
-            recips = map (lambda (name, addr):  addr, recips)
-            for recip in recips:
-                if recip in config['token_recipient']:
-                    sign_message = 1
-                    break
-        if sign_message:
-            token = gen_token (msg)
-            log (INFO, 'Generated token %s.' % token)
-            new_buf = '%s: %s\n' % (config['auth_field'], token) + buf.getvalue ()
-            send_mail (new_buf, mailcmd)
-            log (TRACE, 'Sent tokenized mail.')
-        else:
-            send_mail (buf.getvalue (), mailcmd)
-            log (TRACE, 'Passed mail through unchanged.')
+    #############################
+    def _open (self):
+        import anydbm
+        import fcntl
+        lockfd = open (self.filename + '.lock', 'ab')
+        fcntl.flock (lockfd.fileno (), fcntl.LOCK_EX)
+        try:
+            db = anydbm.open (self.filename, 'c', 0600)
+        except:
+            lockfd.close ()
+            raise
+        return db, lockfd
 
-    except StandardError, txt:
-        log (FATAL, 'Fatal:  caught exception (%s)' % txt)
-        log_exception ()
-        sys.exit (1)
+    #############################
+    def _close (self, db, lockfd):
+        try:
+            db.close ()
+        finally:
+            # Closing the file releases the lock
+            lockfd.close ()
+
+    #############################
+    def add (self, token, keys=()):
+        db, lockfd = self._open ()
+        try:
+            now = str (int (time.time ()))
+            db[token] = now
+            for key in keys:
+                db[key] = '%s %s' % (now, token)
+        finally:
+            self._close (db, lockfd)
+        log (TRACE, 'Recorded token %s in %s.', token, self.filename)
+
+    #############################
+    def index (self, token, keys):
+        db, lockfd = self._open ()
+        try:
+            now = str (int (time.time ()))
+            for key in keys:
+                # Swept by creation time like the tokens
+                db[key] = '%s %s' % (now, token)
+        finally:
+            self._close (db, lockfd)
+
+    #############################
+    def lookup (self, key):
+        db, lockfd = self._open ()
+        try:
+            if not db.has_key (key):
+                return None
+            fields = string.split (db[key])
+        finally:
+            self._close (db, lockfd)
+        oldest = int (time.time ()) - config['token_lifetime']
+        if len (fields) != 2 or int (fields[0]) < oldest:
+            return None
+        return fields[1]
+
+    #############################
+    def claim (self, token):
+        db, lockfd = self._open ()
+        try:
+            if not db.has_key (token):
+                return 0
+            created = int (db[token])
+            del db[token]
+        finally:
+            self._close (db, lockfd)
+        if created < int (time.time ()) - config['token_lifetime']:
+            log (INFO, 'Token %s has expired.', token)
+            return 0
+        return 1
+
+    #############################
+    def mark_used (self, token, issued):
+        db, lockfd = self._open ()
+        try:
+            if db.has_key (token):
+                return 0
+            # Expires along with the token itself
+            db[token] = str (issued)
+        finally:
+            self._close (db, lockfd)
+        return 1
+
+    #############################
+    def sweep (self, oldest, cursor='', limit=0, deadline=None):
+        '''As DotfileTokenStore.sweep ().
+        '''
+        db, lockfd = self._open ()
+        removed = 0
+        try:
+            tokens = filter (lambda token, cursor=cursor: token > cursor,
+                db.keys ())
+            tokens.sort ()
+            if limit and len (tokens) > limit:
+                del tokens[limit:]
+            else:
+                limit = 0
+            for token in tokens:
+                if deadline is not None and time.time () >= deadline:
+                    return removed, cursor
+                cursor = token
+                try:
+                    if int (string.split (db[token])[0]) < oldest:
+                        log (INFO, 'Removing old token %s.', token)
+                        del db[token]
+                        removed = removed + 1
+                except (KeyError, ValueError, IndexError), txt:
+                    log (ERROR, 'Error:  error handling token %s (%s)',
+                        token, txt)
+        finally:
+            self._close (db, lockfd)
+        if limit:
+            return removed, cursor
+        return removed, ''
+
+    #############################
+    def expire (self, oldest):
+        self.sweep (oldest)
 
 #############################
-def process_qsecretary_message ():
-    try:
-        read_config ()
-        log (TRACE)
-        buf = cStringIO.StringIO (sys.stdin.read())
-        msg = rfc822.Message (buf, seekable=1)
-        from_name, from_addr = msg.getaddr ('from')
-        if from_name != 'The qsecretary program':
-            # Not a confirmation message, just quit
-            log (TRACE, 'not a confirmation notice (from "%s" <%s>)'
-                % (from_name or 'Unknown', from_addr or '<Unknown>'))
-            sys.exit (0)
-
-        # Verify the message came from a domain we recognize
-        confirm = 0
-        domain = string.split (from_addr, '@')[-1]
-        cdomains = config['confirm_domain']
-        if type (cdomains) != types.ListType:  cdomains = [cdomains]
-        for cd in cdomains:
-            if cd == domain:  confirm = 1
-        if not confirm:
-            # Didn't come from a site you wish to confirm
-            log (INFO, 'Ignored qsecretary notice (incorrect domain), from "%s"'
-                % from_addr)
-            sys.exit (0)
-
-        # check message here
-        orig_msg = extract_original_message (msg)
-        orig_token = string.strip (orig_msg.getheader (config['auth_field'], ''))
-        if orig_token:
-            log (TRACE, 'Received qsecretary notice with token %s.'
-                % orig_token)
-        else:
-            log (WARN, 'Warning:  failed to find token in message from %s.'
-                % from_addr)
+class BucketedTokenStore:
+    '''Token store sharding token files into subdirectories by creation
+    time window and token prefix:
+
+        <pymsgauth_dir>/buckets/<window start>/<xx>/.<token>
+
+    Expiry removes entire windows without examining individual tokens, and
+    lookups only visit the windows a live token could be in.
+    '''
+    #############################
+    def __init__ (self, path):
+        self.path = os.path.join (path, 'buckets')
+        self.width = config['token_bucket_seconds']
+        if self.width <= 0:
+            raise ConfigurationError, 'token_bucket_seconds must be positive'
+
+    #############################
+    def _window (self, t):
+        return int (t) - int (t) % self.width
+
+    #############################
+    def _token_path (self, window, token):
+        return os.path.join (self.path, str (window), token[:2], '.%s' % token)
+
+    #############################
+    def _make_bucket (self, p):
+        try:
+            os.makedirs (os.path.dirname (p), 0700)
+        except OSError, o:
+            if o.errno != errno.EEXIST:
+                raise
 
-        if check_token (orig_msg, orig_token):
+    #############################
+    def _live_windows (self):
+        '''Return the windows a live token could be in, newest first; most
+        confirmations arrive soon after sending.
+        '''
+        now = int (time.time ())
+        first = self._window (now - config['token_lifetime'])
+        return range (self._window (now), first - 1, -self.width)
+
+    #############################
+    def add (self, token, keys=()):
+        p = self._token_path (self._window (time.time ()), token)
+        self._make_bucket (p)
+        open (p, 'wb')
+        log (TRACE, 'Recorded token %s.', p)
+        self.index (token, keys)
+
+    #############################
+    def index (self, token, keys):
+        window = self._window (time.time ())
+        for key in keys:
+            p = self._token_path (window, key)
+            self._make_bucket (p)
+            write_index_file (p, token)
+
+    #############################
+    def lookup (self, key):
+        for window in self._live_windows ():
+            token = read_index_file (self._token_path (window, key))
+            if token:
+                return token
+        return None
+
+    #############################
+    def mark_used (self, token, issued):
+        # Filed under the issue time, so it expires along with the token
+        p = self._token_path (self._window (issued), token)
+        self._make_bucket (p)
+        return create_exclusive (p)
+
+    #############################
+    def claim (self, token):
+        for window in self._live_windows ():
+            p = self._token_path (window, token)
             try:
-                try:
-                    source_addr = config['confirmation_address']
-                except:
-                    raise ConfigurationError, 'no confirmation_address configured'
-                # Confirm this confirmation notice
-                #confirm_cmd = config['mail_prog'] \
-                #    + ' ' + '-f "%s" "%s"' % (source_addr, from_addr)
-                confirm_cmd = config['mail_prog'][:]
-                confirm_cmd += ['-f', source_addr, from_addr]
-                send_mail ('To: %s\n' % from_addr, confirm_cmd)
-                # Drop confirmation notice after replying
-                log (INFO, 'Authenticated qsecretary notice, from "%s", token "%s"'
-                    % (from_addr, orig_token))
-                sys.exit (99)
-            except ConfigurationError, txt:
-                log (ERROR, 'Error:  failed sending confirmation notice (%s)'
-                    % txt)
-        else:
-            log (ERROR, 'Error:  did not find matching token file (%s)'
-                % orig_token)
+                s = os.lstat (p)
+            except OSError, o:
+                if o.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise
+            if not stat.S_ISREG (s[stat.ST_MODE]):
+                log (WARN, 'Warning:  %s is not a regular file, '
+                    'skipping...', p)
+                continue
+            try:
+                os.unlink (p)
+            except OSError, o:
+                if o.errno == errno.ENOENT:
+                    return 0
+                raise
+            return 1
+        return 0
 
-    except StandardError, txt:
-        log (FATAL, 'Fatal:  caught exception (%s)' % txt)
-        log_exception ()
+    #############################
+    def sweep (self, oldest, cursor='', limit=0, deadline=None):
+        '''As DotfileTokenStore.sweep (), except that expired windows are
+        removed whole, and limit counts windows; windows are visited oldest
+        first, so no cursor is needed.
+        '''
+        import shutil
+        try:
+            names = os.listdir (self.path)
+        except OSError, o:
+            if o.errno == errno.ENOENT:
+                return 0, ''
+            raise
+        windows = []
+        for name in names:
+            try:
+                windows.append ((int (name), name))
+            except ValueError:
+                log (TRACE, 'Ignoring file %s.', name)
+        windows.sort ()
+        removed = 0
+        for (window, name) in windows:
+            if window + self.width > oldest:
+                break
+            if (limit and removed >= limit) or (deadline is not None
+                    and time.time () >= deadline):
+                break
+            log (INFO, 'Removing expired token bucket %s.', name)
+            shutil.rmtree (os.path.join (self.path, name), ignore_errors=1)
+            removed = removed + 1
+        return removed, ''
 
-    # Either the message isn't a qsecretary notice from our message, or
-    # it did not match a recorded token, or we errored.
-    # Exit 0 to allow it to be delivered to user.
-    sys.exit (0)
+    #############################
+    def expire (self, oldest):
+        self.sweep (oldest)
 
+#############################
+def create_exclusive (p):
+    '''Create empty file p; returns 1 if created, 0 if it already existed.
+    '''
+    try:
+        os.close (os.open (p, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600))
+    except OSError, o:
+        if o.errno == errno.EEXIST:
+            return 0
+        raise
+    return 1
+
+#############################
+def write_index_file (p, token):
+    '''Write token to index entry file p.  It is written under a temporary
+    name and renamed into place, so a reader never sees it half-written.
+    '''
+    tmpname = '%s.%i' % (p, os.getpid ())
+    f = open (tmpname, 'wb')
+    f.write (token + '\n')
+    f.close ()
+    os.rename (tmpname, p)
+
+#############################
+def read_index_file (p):
+    '''Return the token in index entry file p, or None if there is none or
+    it is older than token_lifetime (and only awaits removal).
+    '''
+    try:
+        s = os.lstat (p)
+    except OSError, o:
+        if o.errno in (errno.ENOENT, errno.ENOTDIR):
+            return None
+        raise
+    if not stat.S_ISREG (s[stat.ST_MODE]):
+        log (WARN, 'Warning:  %s is not a regular file, skipping...', p)
+        return None
+    if s[stat.ST_CTIME] < int (time.time ()) - config['token_lifetime']:
+        return None
+    try:
+        f = open (p, 'rb')
+    except IOError, o:
+        if o.errno == errno.ENOENT:
+            # Swept meanwhile
+            return None
+        raise
+    token = string.strip (f.read ())
+    f.close ()
+    return token or None
+
+# Available token stores, selected with the token_store option
+token_stores = {
+    'dotfile' : DotfileTokenStore,
+    'dbm' : DbmTokenStore,
+    'bucketed' : BucketedTokenStore,
+}
+
+#############################
+def get_token_store ():
+    try:
+        store_class = token_stores[config['token_store']]
+    except KeyError:
+        raise ConfigurationError, '"%s" not a valid token store' \
+            % config['token_store']
+    return store_class (config['pymsgauth_dir'])
+
+#############################
+class AddressMatcher:
+    '''Matches addresses or domains against a list of patterns, compiled once
+    into dictionaries and a trie of reversed domain labels so that the cost
+    of a match does not depend on the number of patterns.  Matching is
+    case-insensitive.  Address patterns:
+
+        user@example.org        that address
+        *@example.org           any address at example.org
+        *@*.example.org         any address at a subdomain of example.org
+
+    Domain patterns:
+
+        example.org             that domain
+        *.example.org           any subdomain of example.org
+    '''
+    #############################
+    def __init__ (self, patterns):
+        self.addresses = {}
+        self.domains = {}
+        self.subdomains = {}
+        for pattern in patterns:
+            pattern = string.lower (string.strip (pattern))
+            if '@' in pattern:
+                local, domain = string.split (pattern, '@', 1)
+                if local != '*':
+                    self.addresses[pattern] = 1
+                    continue
+            else:
+                domain = pattern
+            if domain[:2] == '*.':
+                node = self.subdomains
+                labels = string.split (domain[2:], '.')
+                labels.reverse ()
+                for label in labels:
+                    node = node.setdefault (label, {})
+                # Empty key marks the end of a pattern
+                node[''] = 1
+            else:
+                self.domains[domain] = 1
+
+    #############################
+    def match_domain (self, domain):
+        domain = string.lower (domain)
+        if self.domains.has_key (domain):
+            return 1
+        labels = string.split (domain, '.')
+        labels.reverse ()
+        node = self.subdomains
+        # The last label must be left over to be a proper subdomain
+        for label in labels[:-1]:
+            node = node.get (label)
+            if node is None:
+                return 0
+            if node.has_key (''):
+                return 1
+        return 0
+
+    #############################
+    def match_address (self, address):
+        address = string.lower (address)
+        if self.addresses.has_key (address):
+            return 1
+        if '@' not in address:
+            return 0
+        return self.match_domain (string.split (address, '@')[-1])
+
+# Compiled AddressMatcher objects for the configured pattern lists, by option
+# name; emptied whenever the configuration is re-read.
+matchers = {}
+
+#############################
+def get_matcher (option):
+    try:
+        return matchers[option]
+    except KeyError:
+        matcher = matchers[option] = AddressMatcher (config[option])
+        return matcher
+
+#############################
+def gen_hmac_token (issued, nonce):
+    import hmac
+    import sha
+    if not config['secret']:
+        raise ConfigurationError, 'hmac tokens require a secret'
+    stamp = '%08x%s' % (issued, nonce)
+    digest = hmac.new (config['secret'], stamp, sha).hexdigest ()
+    return 'h%s%s' % (stamp, digest)
+
+#############################
+def message_keys (msg):
+    '''Return the keys indexing the token sent with msg (an rfc822.Message
+    of its header):  one for its Message-ID, and, if it has a Date field, one
+    for a digest of its index_fields.  Whitespace is normalized, so
+    refolding by a relay does not change them.
+    '''
+    import sha
+    keys = []
+    msgid = string.join (string.split (msg.getheader ('message-id', '')))
+    if msgid:
+        keys.append (index_key_prefix
+            + sha.new ('message-id:%s' % msgid).hexdigest ())
+    if msg.getheader ('date'):
+        fields = []
+        for name in index_fields:
+            fields.append ('%s:%s' % (name,
+                string.join (string.split (msg.getheader (name, '')))))
+        keys.append (index_key_prefix
+            + sha.new (string.join (fields, '\n')).hexdigest ())
+    return keys
+
+#############################
+def gen_token (msg):
+    if config['message_index']:
+        keys = message_keys (msg)
+    else:
+        keys = []
+    if config['token_format'] == 'hmac':
+        # Self-validating; nothing is recorded until it is confirmed, except
+        # its index entries
+        token = gen_hmac_token (int (time.time ()),
+            os.urandom (4).encode ('hex'))
+        if keys:
+            try:
+                get_token_store ().index (token, keys)
+            except (IOError, OSError), txt:
+                log (WARN, 'Warning:  failed indexing token %s (%s)', token,
+                    txt)
+        return token
+    elif config['token_format'] != 'random':
+        raise ConfigurationError, '"%s" not a valid token format' \
+            % config['token_format']
+    import sha
+    token = sha.new('%s,%s,%s,%s'
+        % (os.getpid(), time.time(), string.join (msg.headers),
+            config['secret'])).hexdigest()
+    # Record token
+    try:
+        get_token_store ().add (token, keys)
+    except (IOError, OSError), txt:
+        log (FATAL, 'Fatal:  exception recording token %s (%s)', token, txt)
+        raise
+    return token
+
+#############################
+def check_hmac_token (token):
+    '''Validate hmac token; returns its issue time, or None if it is forged,
+    malformed or expired.
+    '''
+    try:
+        issued = int (token[1:9], 16)
+    except ValueError:
+        return None
+    expected = gen_hmac_token (issued, token[9:17])
+    # Compare without leaking the position of the first difference
+    diff = len (expected) ^ len (token)
+    for (a, b) in zip (expected, token):
+        diff = diff | (ord (a) ^ ord (b))
+    if diff:
+        log (WARN, 'Warning:  token %s failed authentication', token)
+        return None
+    now = int (time.time ())
+    if issued < now - config['token_lifetime'] or issued > now + 300:
+        log (INFO, 'Token %s has expired.', token)
+        return None
+    return issued
+
+#############################
+def find_indexed_token (msg):
+    '''Return the token sent with the message whose header msg quotes, found
+    by its index keys, or None.
+    '''
+    store = get_token_store ()
+    try:
+        for key in message_keys (msg):
+            token = store.lookup (key)
+            if token:
+                return token
+    except (IOError, OSError), txt:
+        log (FATAL, 'Fatal:  error looking up token index (%s)', txt)
+        raise
+    return None
+
+#############################
+def check_token (msg, token):
+    if token[:1] == index_key_prefix:
+        # An index entry, not a token
+        log (WARN, 'Warning:  token %s is not valid', token)
+        return 0
+    try:
+        if token[:1] == 'h' and len (token) == hmac_token_length:
+            issued = check_hmac_token (token)
+            # Record the token as used, so it cannot be replayed
+            if issued is None \
+                    or not get_token_store ().mark_used (token, issued):
+                return 0
+            log (INFO, 'Matched token %s, recorded as used.', token)
+        else:
+            # Find and remove existing token
+            if not get_token_store ().claim (token):
+                return 0
+            log (INFO, 'Matched token %s, removed.', token)
+    except (IOError, OSError), txt:
+        log (FATAL, 'Fatal:  error handling token %s (%s)', token, txt)
+        raise
+    return 1
+
+#############################
+class DeliveryResult:
+    '''Outcome of running a mail command with send_mail ().
+    '''
+    #############################
+    def __init__ (self, mailcmd):
+        self.mailcmd = mailcmd
+        # Wait status, as from os.waitpid ()
+        self.status = None
+        self.out = ''
+        self.err = ''
+        # Set if the command was killed for running past mail_timeout
+        self.timed_out = 0
+        self.elapsed = 0.0
+
+    #############################
+    def exitcode (self):
+        '''Exit code to pass on to our caller; 0 if delivery succeeded.
+        '''
+        if self.timed_out:
+            # Temporary failure; let qmail try again later
+            return 111
+        if os.WIFEXITED (self.status):
+            if os.WEXITSTATUS (self.status):
+                return os.WEXITSTATUS (self.status)
+            if self.err:
+                return 1
+            return 0
+        return 127
+
+    #############################
+    def ok (self):
+        return not self.exitcode ()
+
+    #############################
+    def describe (self):
+        if self.err:
+            errtext = ', err: "%s"' % self.err
+        else:
+            errtext = ''
+        if self.timed_out:
+            return 'mail command %s timed out (killed after %i seconds)%s' \
+                % (self.mailcmd, self.elapsed, errtext)
+        if os.WIFSIGNALED (self.status):
+            return 'mail command %s killed by signal %s%s' \
+                % (self.mailcmd, os.WTERMSIG (self.status), errtext)
+        if os.WIFEXITED (self.status) and os.WEXITSTATUS (self.status):
+            return 'mail command %s exited %s%s' \
+                % (self.mailcmd, os.WEXITSTATUS (self.status), errtext)
+        if self.err:
+            return 'mail command %s error: "%s"' % (self.mailcmd, self.err)
+        return 'mail command %s succeeded' % self.mailcmd
+
+#############################
+def send_mail (msgbuf, mailcmd, fp=None):
+    '''Run mailcmd, feeding it msgbuf followed by the rest of file fp (if
+    given), which is copied in io_chunk_size pieces rather than read into
+    memory.  The command's stdin, stdout and stderr are serviced together,
+    so it cannot deadlock on a full pipe.  If it runs longer than
+    mail_timeout seconds, it is sent SIGTERM, then SIGKILL mail_kill_grace
+    seconds later.  Returns a DeliveryResult.
+    '''
+    import subprocess
+    import select
+    import signal
+    import fcntl
+    log (TRACE, 'Mail command is "%s".', mailcmd)
+    result = DeliveryResult (mailcmd)
+    start = time.time ()
+    if config['mail_timeout'] > 0:
+        deadline = start + config['mail_timeout']
+    else:
+        deadline = None
+    cmd = subprocess.Popen (mailcmd, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+
+    infd = cmd.stdin.fileno ()
+    fcntl.fcntl (infd, fcntl.F_SETFL,
+        fcntl.fcntl (infd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    outputs = {cmd.stdout.fileno () : [], cmd.stderr.fileno () : []}
+    poller = select.poll ()
+    poller.register (infd, select.POLLOUT)
+    for fd in outputs.keys ():
+        poller.register (fd, select.POLLIN)
+    open_fds = [infd] + outputs.keys ()
+    pending = msgbuf
+    signals = [signal.SIGTERM, signal.SIGKILL]
+
+    while open_fds:
+        if deadline is None:
+            timeout = None
+        else:
+            if time.time () >= deadline:
+                if not signals:
+                    break
+                log (TRACE, 'killing mail command')
+                result.timed_out = 1
+                try:
+                    os.kill (cmd.pid, signals.pop (0))
+                except OSError:
+                    pass
+                deadline = time.time () + mail_kill_grace
+            timeout = max (0, int ((deadline - time.time ()) * 1000)) + 1
+        try:
+            events = poller.poll (timeout)
+        except select.error, o:
+            if o.args[0] == errno.EINTR:
+                continue
+            raise
+        for (fd, event) in events:
+            if fd == infd:
+                if not event & (select.POLLERR | select.POLLHUP):
+                    if not pending and fp is not None:
+                        pending = fp.read (io_chunk_size)
+                        if not pending:
+                            fp = None
+                    try:
+                        if pending:
+                            pending = pending[os.write (infd, pending):]
+                    except OSError, o:
+                        if o.errno == errno.EAGAIN:
+                            continue
+                        if o.errno != errno.EPIPE:
+                            raise
+                        # Command quit reading; its exit status will tell
+                        pending = ''
+                        fp = None
+                    if pending or fp is not None:
+                        continue
+                poller.unregister (infd)
+                open_fds.remove (infd)
+                cmd.stdin.close ()
+            else:
+                data = os.read (fd, io_chunk_size)
+                if data:
+                    outputs[fd].append (data)
+                    continue
+                poller.unregister (fd)
+                open_fds.remove (fd)
+
+    if not cmd.stdin.closed:
+        cmd.stdin.close ()
+
+    # Outputs are closed (or we have given up); wait for the command to exit
+    while deadline is not None:
+        if cmd.poll () is not None:
+            break
+        if time.time () >= deadline:
+            result.timed_out = 1
+            try:
+                if signals:
+                    os.kill (cmd.pid, signals.pop (0))
+                    deadline = time.time () + mail_kill_grace
+                else:
+                    deadline = None
+            except OSError:
+                pass
+        time.sleep (0.005)
+    cmd.wait ()
+
+    # Convert subprocess's returncode back into a wait status
+    if cmd.returncode < 0:
+        result.status = -cmd.returncode
+    else:
+        result.status = cmd.returncode << 8
+    result.out = string.strip (string.join (outputs[cmd.stdout.fileno ()], ''))
+    result.err = string.strip (string.join (outputs[cmd.stderr.fileno ()], ''))
+    cmd.stdout.close ()
+    cmd.stderr.close ()
+    result.elapsed = time.time () - start
+    log (TRACE, 'status == %s', result.status)
+
+    if result.out:
+        log (WARN, 'Warning:  command "%s" said "%s"', mailcmd, result.out)
+    return result
+
+#############################
+def mail_envelope (msgbuf, mailcmd):
+    '''Work out the envelope (sender, [recipients]) qmail-inject would use
+    when run as mailcmd on a message whose header starts msgbuf, or None if
+    it would take the recipients from the header (-h, -H, -t, or no
+    recipient arguments) or the sender from a Return-Path: field, or if
+    QMAILINJECT changes either.  The sender is the -f argument or, failing
+    that, inject_sender ().
+    '''
+    if os.environ.get ('QMAILINJECT'):
+        return None
+    sender = None
+    recips = []
+    args = mailcmd[1:]
+    i = 0
+    while i < len (args):
+        arg = args[i]
+        i = i + 1
+        if arg == '--':
+            recips.extend (args[i:])
+            break
+        if arg[:1] != '-' or arg == '-':
+            recips.append (arg)
+        elif arg[1] in 'fF':
+            value = arg[2:]
+            if not value and i < len (args):
+                value = args[i]
+                i = i + 1
+            if arg[1] == 'f':
+                sender = value
+        elif arg[1] in 'hHt':
+            return None
+    if not recips:
+        return None
+    import rfc822
+    import cStringIO
+    if rfc822.Message (cStringIO.StringIO (msgbuf)).has_key ('return-path'):
+        return None
+    if sender is None:
+        sender = inject_sender ()
+        if sender is None:
+            return None
+    return sender, recips
+
+#############################
+def inject_sender ():
+    '''Return the envelope sender qmail-inject uses when not given one,
+    user@host from the QMAILSUSER and QMAILSHOST environment variables or
+    the ones standing in for them, or None if no host is known.
+    '''
+    env = os.environ.get
+    user = env ('QMAILSUSER') or env ('QMAILUSER') or env ('MAILUSER') \
+        or env ('USER') or env ('LOGNAME') or 'anonymous'
+    host = env ('QMAILSHOST') or env ('QMAILHOST') or env ('MAILHOST') \
+        or env ('QMAILDEFAULTHOST')
+    for name in ('defaulthost', 'me'):
+        if host:
+            break
+        try:
+            f = open (os.path.join (qmail_control_dir, name))
+            host = string.strip (f.readline ())
+            f.close ()
+        except IOError:
+            pass
+    if not host:
+        return None
+    return '%s@%s' % (user, host)
+
+#############################
+def inject_filter (msgbuf):
+    '''Return message msgbuf without the header fields qmail-inject would
+    remove (Bcc: and Resent-Bcc:, with their continuation lines).
+    '''
+    import cStringIO
+    fp = cStringIO.StringIO (msgbuf)
+    header = read_header_block (fp)
+    lines = []
+    removed = 0
+    for line in cStringIO.StringIO (header).readlines ():
+        if line[:1] not in (' ', '\t'):
+            name = string.lower (string.strip (string.split (line, ':')[0]))
+            removed = name in inject_removed_fields
+        if not removed:
+            lines.append (line)
+    return string.join (lines, '') + fp.read ()
+
+#############################
+class SMTPSubmitter:
+    '''Persistent SMTP connection to the submission_host server.
+    '''
+    #############################
+    def __init__ (self, host, port, timeout):
+        import smtplib
+        self.conn = smtplib.SMTP (host, port or 25, timeout=timeout)
+        self.conn.ehlo_or_helo_if_needed ()
+
+    #############################
+    def submit (self, msgbuf, sender, recips):
+        '''Send message; returns (exit code, error text).  Raises
+        NotSubmitted if the connection fails before the message data is
+        sent, and other errors if it fails after.
+        '''
+        import smtplib
+        import socket
+        try:
+            code, text = self.conn.mail (sender)
+            if code != 250:
+                self.conn.rset ()
+                return smtp_exitcode (code), 'sender refused (%s %s)' \
+                    % (code, text)
+            refused = {}
+            for recip in recips:
+                code, text = self.conn.rcpt (recip)
+                if code not in (250, 251):
+                    refused[recip] = (code, text)
+            if len (refused) == len (recips):
+                self.conn.rset ()
+                code, text = refused.values ()[0]
+                return smtp_exitcode (code), 'recipients refused (%s %s)' \
+                    % (code, text)
+        except (smtplib.SMTPServerDisconnected, socket.error), txt:
+            # Typically a reused connection the server has since dropped
+            raise NotSubmitted, str (txt)
+        try:
+            code, text = self.conn.data (msgbuf)
+        except smtplib.SMTPDataError, o:
+            # Refused before any of the message was sent
+            self.conn.rset ()
+            return smtp_exitcode (o.smtp_code), '%s %s' \
+                % (o.smtp_code, o.smtp_error)
+        if code != 250:
+            return smtp_exitcode (code), '%s %s' % (code, text)
+        for (recip, (code, text)) in refused.items ():
+            log (WARN, 'Warning:  recipient %s refused (%s %s)',
+                recip, code, text)
+        return 0, ''
+
+    #############################
+    def close (self):
+        try:
+            self.conn.quit ()
+        except Exception:
+            # smtplib's exceptions are not StandardErrors
+            self.conn.close ()
+
+#############################
+def smtp_exitcode (code):
+    if code >= 500:
+        return 100
+    return 111
+
+#############################
+class QMQPSubmitter:
+    '''Connection to a qmail-qmqpd server.  QMQP carries one message per
+    connection, so a new one is made for each message.
+    '''
+    #############################
+    def __init__ (self, host, port, timeout):
+        self.address = (host, port or 628)
+        self.timeout = timeout
+
+    #############################
+    def submit (self, msgbuf, sender, recips):
+        '''As SMTPSubmitter.submit ().
+        '''
+        import socket
+        import pymsgauthclient
+        netstring = pymsgauthclient.netstring
+        packet = [netstring (msgbuf), netstring (sender)]
+        for recip in recips:
+            packet.append (netstring (recip))
+        try:
+            s = socket.create_connection (self.address, self.timeout)
+        except socket.error, txt:
+            raise NotSubmitted, str (txt)
+        try:
+            s.sendall (netstring (string.join (packet, '')))
+            response = pymsgauthclient.read_netstring (s.makefile ('rb'))
+        finally:
+            s.close ()
+        if response[:1] == 'K':
+            return 0, ''
+        if response[:1] == 'D':
+            return 100, response[1:]
+        return 111, response[1:]
+
+    #############################
+    def close (self):
+        pass
+
+# Submission backends, selected with the submission option
+submitters = {
+    'smtp' : SMTPSubmitter,
+    'qmqp' : QMQPSubmitter,
+}
+
+# Connected submitters not currently in use, for reuse by later messages
+idle_submitters = []
+
+# Set once close_submitters () is registered to run at exit
+close_submitters_registered = 0
+
+#############################
+def get_submitter ():
+    '''Return a connected submitter, or None if the server cannot be
+    reached.
+    '''
+    global close_submitters_registered
+    try:
+        return idle_submitters.pop ()
+    except IndexError:
+        pass
+    try:
+        submitter_class = submitters[config['submission']]
+    except KeyError:
+        raise ConfigurationError, '"%s" not a valid submission method' \
+            % config['submission']
+    try:
+        submitter = submitter_class (config['submission_host'],
+            config['submission_port'], config['mail_timeout'] or None)
+    except Exception, txt:
+        # Includes smtplib's exceptions, which are not StandardErrors
+        log (WARN, 'Warning:  cannot connect to %s server %s (%s)',
+            config['submission'], config['submission_host'], txt)
+        return None
+    if not close_submitters_registered:
+        import atexit
+        atexit.register (close_submitters)
+        close_submitters_registered = 1
+    return submitter
+
+#############################
+def close_submitters ():
+    while idle_submitters:
+        idle_submitters.pop ().close ()
+
+#############################
+def submit_mail (msgbuf, sender, recips):
+    '''Submit the message msgbuf over a network connection as configured by
+    submission.  Returns a DeliveryResult, or None if the message could not
+    be handed to the server at all.
+    '''
+    submitter = None
+    description = '%s://%s' % (config['submission'], config['submission_host'])
+    log (TRACE, 'Submitting to %s.', description)
+    result = DeliveryResult (description)
+    start = time.time ()
+    while 1:
+        reused = len (idle_submitters)
+        submitter = get_submitter ()
+        if submitter is None:
+            return None
+        try:
+            code, err = submitter.submit (msgbuf, sender, recips)
+        except NotSubmitted, txt:
+            submitter.close ()
+            if not reused:
+                log (WARN, 'Warning:  cannot submit to %s (%s)', description,
+                    txt)
+                return None
+            # A reused connection the server had dropped; nothing was sent,
+            # so try again
+            continue
+        except Exception, txt:
+            # Includes smtplib's exceptions, which are not StandardErrors.
+            # The server may have the message already, so it is not retried.
+            submitter.close ()
+            code, err = 111, str (txt)
+        else:
+            idle_submitters.append (submitter)
+        break
+    result.status = code << 8
+    result.err = err
+    result.elapsed = time.time () - start
+    return result
+
+#############################
+def deliver (msgbuf, mailcmd, fp=None):
+    '''Send the message (msgbuf followed by the rest of file fp, if given)
+    as mailcmd would, using the configured submission method; falls back to
+    running mailcmd with send_mail ().  Raises DeliveryError if delivery
+    fails.
+    '''
+    result = None
+    start = time.time ()
+    if config['submission'] != 'inject':
+        envelope = mail_envelope (msgbuf, mailcmd)
+        if envelope:
+            sender, recips = envelope
+            if fp:
+                # Needed whole, and again if sent with mailcmd after all
+                msgbuf = msgbuf + fp.read ()
+                fp = None
+            result = submit_mail (inject_filter (msgbuf), sender, recips)
+        else:
+            log (DEBUG, 'cannot determine envelope, using %s', mailcmd)
+    if result is None:
+        result = send_mail (msgbuf, mailcmd, fp)
+    stats_timing ('deliver', start)
+    if not result.ok ():
+        raise DeliveryError (result.describe (), result.exitcode ())
+    log (TRACE, 'Sent mail.')
+    return result
+
+#############################
+def stdin_offset ():
+    '''Return the current offset of sys.stdin in its file, if it is an
+    unread regular file which another program could be handed; else None.
+    '''
+    try:
+        fd = sys.stdin.fileno ()
+        if not stat.S_ISREG (os.fstat (fd)[stat.ST_MODE]):
+            return None
+        return os.lseek (fd, 0, 1)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+#############################
+def exec_mail (mailcmd, offset):
+    '''Replace this process with mailcmd, reading the message from stdin
+    starting at offset.  Only returns by raising DeliveryError.
+    '''
+    log (TRACE, 'executing %s', mailcmd)
+    finish_profile ()
+    flush_log ()
+    flush_stats ()
+    sys.stdout.flush ()
+    sys.stderr.flush ()
+    os.lseek (sys.stdin.fileno (), offset, 0)
+    if config['mail_timeout'] > 0:
+        # Pending alarms survive exec; SIGALRM kills mailcmd at the deadline
+        import signal
+        signal.alarm (config['mail_timeout'])
+    try:
+        os.execvp (mailcmd[0], mailcmd)
+    except OSError, txt:
+        raise DeliveryError ('failed running mail command %s (%s)'
+            % (mailcmd, txt))
+
+#############################
+def sweep_tokens (limit, budget):
+    '''Remove a batch of expired tokens:  at most limit (0 for no limit),
+    for at most budget seconds (0 for no limit).  A limited batch carries
+    on from where the last one stopped, as recorded in the sweep cursor
+    file.  Returns the number of tokens removed.
+    '''
+    cursor_file = os.path.join (config['pymsgauth_dir'],
+        sweep_cursor_filename)
+    cursor = ''
+    if limit or budget:
+        try:
+            cursor = string.strip (open (cursor_file).read ())
+        except IOError:
+            pass
+    if budget:
+        deadline = time.time () + budget
+    else:
+        deadline = None
+    oldest = int (time.time ()) - config['token_lifetime']
+    removed, cursor = get_token_store ().sweep (oldest, cursor, limit,
+        deadline)
+    # Also marks when the last batch ran
+    tmpname = '%s.%i' % (cursor_file, os.getpid ())
+    f = open (tmpname, 'w')
+    f.write (cursor + '\n')
+    f.close ()
+    os.rename (tmpname, cursor_file)
+    return removed
+
+#############################
+def sweep_tokens_if_due ():
+    '''Run a batch of token expiry if clean_interval is set and no batch has
+    run for that long.  Errors are logged, not raised.
+    '''
+    if not config['clean_interval']:
+        return
+    try:
+        last = os.stat (os.path.join (config['pymsgauth_dir'],
+            sweep_cursor_filename))[stat.ST_MTIME]
+    except OSError:
+        last = 0
+    if time.time () - last < config['clean_interval']:
+        return
+    start = time.time ()
+    try:
+        removed = sweep_tokens (config['clean_batch'] or sweep_send_batch,
+            config['clean_time_budget'])
+        log (DEBUG, 'Removed %i expired tokens.', removed)
+    except (IOError, OSError), txt:
+        log (WARN, 'Warning:  failed removing expired tokens (%s)', txt)
+    stats_timing ('sweep', start)
+
+#############################
+def clean_old_tokens ():
+    try:
+        read_config ()
+        log (TRACE)
+        start = time.time ()
+        sweep_tokens (config['clean_batch'], config['clean_time_budget'])
+        stats_timing ('clean', start)
+
+    except StandardError, txt:
+        log (FATAL, 'Fatal:  caught exception (%s)', txt)
+        log_exception ()
+        sys.exit (1)
+
+clean_old_tokens = profiled ('clean', clean_old_tokens)
+
+#############################
+def sendmail_wrapper (args):
+    try:
+        read_config ()
+        log (TRACE)
+        #mailcmd = (os.environ.get ('MAIL_PROG', config['mail_prog'])
+        #    + ' '
+        #    + config['extra_mail_args']
+        #    + ' '
+        #    + string.join (args))
+        mailcmd = config['mail_prog'][:]
+        if config['extra_mail_args']:
+            mailcmd += config['extra_mail_args']
+        mailcmd += args
+        log (TRACE, 'mailcmd == %s', mailcmd)
+        if config['passthrough_exec'] and config['submission'] == 'inject':
+            offset = stdin_offset ()
+        else:
+            offset = None
+        # Only the header block is read here; the body is streamed straight
+        # from stdin to the mail command.
+        start = time.time ()
+        header = read_header_block (sys.stdin)
+        import rfc822
+        import cStringIO
+        msg = rfc822.Message (cStringIO.StringIO (header))
+        stats_timing ('parse', start)
+
+        start = time.time ()
+        token_recipients = get_matcher ('token_recipient')
+        sign_message = 0
+        for arg in args:
+            if token_recipients.match_address (arg):
+                sign_message = 1
+                break
+        if not sign_message:
+            recips = []
+            for field in ('to', 'cc', 'bcc', 'resent-to', 'resent-cc', 'resent-bcc'):
+                recips.extend (msg.getaddrlist (field))
+            recips = map (lambda (name, addr):  addr, recips)
+            for recip in recips:
+                if token_recipients.match_address (recip):
+                    sign_message = 1
+                    break
+        stats_timing ('classify', start)
+        if sign_message:
+            start = time.time ()
+            token = gen_token (msg)
+            stats_timing ('token', start)
+            log (INFO, 'Generated token %s.', token)
+            deliver ('%s: %s\n' % (config['auth_field'], token) + header,
+                mailcmd, sys.stdin)
+            stats_count ('signed')
+            log (TRACE, 'Sent tokenized mail.')
+            # Amortized expiry, once the mail is on its way
+            sweep_tokens_if_due ()
+        elif offset is not None:
+            # Unchanged; let mail_prog read it from the start itself
+            stats_count ('passthrough')
+            exec_mail (mailcmd, offset)
+        else:
+            deliver (header, mailcmd, sys.stdin)
+            stats_count ('passthrough')
+            log (TRACE, 'Passed mail through unchanged.')
+
+    except DeliveryError, txt:
+        stats_count ('failed')
+        log (FATAL, 'Fatal:  failed sending mail (%s)', txt)
+        sys.exit (txt.exitcode)
+
+    except StandardError, txt:
+        stats_count ('failed')
+        log (FATAL, 'Fatal:  caught exception (%s)', txt)
+        log_exception ()
+        sys.exit (1)
+
+sendmail_wrapper = profiled ('mail', sendmail_wrapper)
+
+#############################
+class RecentConfirmations:
+    '''Bounded record of the confirmations sent recently, as lines of
+    "<time> <token> <address>" in a file in the configuration/data
+    directory:  at most confirm_memory_size of them, none older than
+    token_lifetime.  Access is serialized with flock() on a separate lock
+    file, which lock () takes and unlock () releases.
+    '''
+    #############################
+    def __init__ (self, path):
+        self.filename = os.path.join (path, recent_confirmations_filename)
+        self.lockfd = None
+
+    #############################
+    def lock (self):
+        import fcntl
+        self.lockfd = open (self.filename + '.lock', 'ab')
+        fcntl.flock (self.lockfd.fileno (), fcntl.LOCK_EX)
+
+    #############################
+    def unlock (self):
+        # Closing the file releases the lock
+        self.lockfd.close ()
+        self.lockfd = None
+
+    #############################
+    def _load (self):
+        oldest = time.time () - config['token_lifetime']
+        entries = []
+        try:
+            f = open (self.filename)
+        except IOError, o:
+            if o.errno == errno.ENOENT:
+                return entries
+            raise
+        for line in f.readlines ():
+            fields = string.split (line)
+            try:
+                if len (fields) == 3 and int (fields[0]) >= oldest:
+                    entries.append (fields)
+            except ValueError:
+                pass
+        f.close ()
+        return entries
+
+    #############################
+    def _save (self, entries):
+        del entries[:-config['confirm_memory_size']]
+        tmpname = '%s.%i' % (self.filename, os.getpid ())
+        f = open (tmpname, 'w')
+        for entry in entries:
+            f.write ('%s\n' % string.join (entry))
+        f.close ()
+        os.rename (tmpname, self.filename)
+
+    #############################
+    def note (self, token, address, claimed):
+        '''Return the addresses (in lower case) confirmations carrying token
+        have been sent to, and those to which sending failed (marked with a
+        leading '!').  Then record that one is being sent to address, if
+        the token was just claimed or sending to address had failed.  Must
+        be called with the lock held.
+        '''
+        entries = self._load ()
+        known = []
+        for (issued, entry_token, entry_address) in entries:
+            if entry_token == token:
+                known.append (string.lower (entry_address))
+        if claimed:
+            entries.append ([str (int (time.time ())), token, address])
+            self._save (entries)
+        elif '!' + string.lower (address) in known:
+            # Being sent again
+            unsent = '!' + string.lower (address)
+            for entry in entries:
+                if entry[1] == token and string.lower (entry[2]) == unsent:
+                    entry[2] = entry[2][1:]
+            self._save (entries)
+        return known
+
+    #############################
+    def unsent (self, token, address):
+        '''Mark the confirmation carrying token to address as not sent after
+        all:  the token still counts as confirmed, but a notice from address
+        will be answered again.  Must be called with the lock held.
+        '''
+        entries = self._load ()
+        for entry in entries:
+            if entry[1] == token \
+                    and string.lower (entry[2]) == string.lower (address):
+                entry[2] = '!' + entry[2]
+        self._save (entries)
+
+#############################
+def get_recent_confirmations ():
+    '''Return the RecentConfirmations record, or None if confirm_memory_size
+    is 0.
+    '''
+    if config['confirm_memory_size'] <= 0:
+        return None
+    return RecentConfirmations (config['pymsgauth_dir'])
+
+#############################
+def send_confirmation (sender, recipient):
+    '''Reply to the qsecretary notice from recipient, as sender.  Raises
+    DeliveryError if delivery fails.
+    '''
+    confirm_cmd = config['mail_prog'][:]
+    confirm_cmd += ['-f', sender, recipient]
+    deliver ('To: %s\n' % recipient, confirm_cmd)
+
+#############################
+def fsync_dir (path):
+    fd = os.open (path, os.O_RDONLY)
+    try:
+        os.fsync (fd)
+    finally:
+        os.close (fd)
+
+#############################
+class ConfirmationSpool:
+    '''Queue of confirmations waiting to be sent, kept Maildir-style in
+    directory path:  entries are written to tmp, moved to new once synced to
+    disk, and moved to cur while a flusher is sending them.  Entry names are
+    <time>.P<pid>R<random>.<host>, followed by ',<attempts>' once sending
+    has failed; the modification time of an entry in new is when it may
+    next be tried.
+    '''
+    #############################
+    def __init__ (self, path):
+        self.path = path
+        # Entries written to tmp but not yet committed, as (name, sender,
+        # recipient)
+        self.unsynced = []
+        self.lock = thread.allocate_lock ()
+
+    #############################
+    def _dir (self, subdir, name=''):
+        return os.path.join (self.path, subdir, name)
+
+    #############################
+    def add (self, sender, recipient, token):
+        '''Write an entry to tmp; it is only seen by flushers once
+        commit () has been called.
+        '''
+        for subdir in ('tmp', 'new', 'cur'):
+            if not os.path.isdir (self._dir (subdir)):
+                try:
+                    os.makedirs (self._dir (subdir), 0700)
+                except OSError, o:
+                    if o.errno != errno.EEXIST:
+                        raise
+        import socket
+        name = '%d.P%dR%s.%s' % (time.time (), os.getpid (),
+            os.urandom (4).encode ('hex'),
+            string.replace (socket.gethostname (), '/', '\\057'))
+        f = open (self._dir ('tmp', name), 'wb')
+        f.write ('Sender: %s\nRecipient: %s\nToken: %s\n'
+            % (sender, recipient, token))
+        f.close ()
+        self.lock.acquire ()
+        self.unsynced.append ((name, sender, recipient))
+        self.lock.release ()
+
+    #############################
+    def commit (self):
+        '''Sync every entry added so far to disk and move them into new,
+        with one sync of the directory for all of them.  Entries which
+        cannot be moved are sent directly instead; raises DeliveryError if
+        that fails.
+        '''
+        self.lock.acquire ()
+        entries = self.unsynced
+        self.unsynced = []
+        self.lock.release ()
+        if not entries:
+            return
+        failed = []
+        # Held back for confirm_coalesce_window seconds, so duplicates
+        # spooled meanwhile can be sent together
+        due = time.time () + config['confirm_coalesce_window']
+        for (name, sender, recipient) in entries:
+            try:
+                if config['confirm_coalesce_window'] > 0:
+                    os.utime (self._dir ('tmp', name), (due, due))
+                fd = os.open (self._dir ('tmp', name), os.O_RDONLY)
+                try:
+                    os.fsync (fd)
+                finally:
+                    os.close (fd)
+                os.rename (self._dir ('tmp', name), self._dir ('new', name))
+            except OSError, txt:
+                log (WARN, 'Warning:  failed spooling confirmation to %s '
+                    '(%s), sending it now', recipient, txt)
+                failed.append ((name, sender, recipient))
+        try:
+            fsync_dir (self._dir ('new'))
+        except OSError, txt:
+            # Already visible to flushers; sending them here as well could
+            # confirm twice
+            log (WARN, 'Warning:  failed syncing %s (%s)', self._dir ('new'),
+                txt)
+        for (name, sender, recipient) in failed:
+            send_confirmation (sender, recipient)
+            try:
+                os.unlink (self._dir ('tmp', name))
+            except OSError:
+                pass
+
+    #############################
+    def recover (self, stale):
+        '''Return entries left in cur for more than stale seconds (by a
+        flusher which died) to new, and remove abandoned entries in tmp.
+        '''
+        now = time.time ()
+        for (subdir, age) in (('cur', stale), ('tmp', 36 * 3600)):
+            try:
+                names = os.listdir (self._dir (subdir))
+            except OSError, o:
+                if o.errno == errno.ENOENT:
+                    continue
+                raise
+            for name in names:
+                p = self._dir (subdir, name)
+                try:
+                    if now - os.stat (p)[stat.ST_CTIME] < age:
+                        continue
+                    if subdir == 'cur':
+                        log (INFO, 'Returning stale spool entry %s.', name)
+                        os.rename (p, self._dir ('new', name))
+                    else:
+                        log (INFO, 'Removing abandoned spool entry %s.', name)
+                        os.unlink (p)
+                except OSError, o:
+                    if o.errno != errno.ENOENT:
+                        raise
+
+    #############################
+    def ready (self):
+        '''Return the names of the entries in new due to be tried, oldest
+        first.
+        '''
+        now = time.time ()
+        try:
+            names = os.listdir (self._dir ('new'))
+        except OSError, o:
+            if o.errno == errno.ENOENT:
+                return []
+            raise
+        due = []
+        for name in names:
+            if name[0] == '.':
+                continue
+            try:
+                if os.stat (self._dir ('new', name))[stat.ST_MTIME] <= now:
+                    due.append (name)
+            except OSError, o:
+                if o.errno != errno.ENOENT:
+                    raise
+        due.sort ()
+        return due
+
+    #############################
+    def read (self, name, subdir='new'):
+        '''Return (sender, recipient, token) from entry name, or None if it
+        has gone.
+        '''
+        try:
+            f = open (self._dir (subdir, name))
+        except IOError, o:
+            if o.errno == errno.ENOENT:
+                return None
+            raise
+        fields = {}
+        for line in f.readlines ():
+            key, value = (string.split (line, ':', 1) + [''])[:2]
+            fields[string.lower (key)] = string.strip (value)
+        f.close ()
+        return (fields.get ('sender', ''), fields.get ('recipient', ''),
+            fields.get ('token', ''))
+
+    #############################
+    def claim (self, name):
+        '''Move entry name into cur and return (sender, recipient, token),
+        or None if another flusher took it first.
+        '''
+        try:
+            os.rename (self._dir ('new', name), self._dir ('cur', name))
+        except OSError, o:
+            if o.errno == errno.ENOENT:
+                return None
+            raise
+        return self.read (name, 'cur')
+
+    #############################
+    def done (self, name):
+        os.unlink (self._dir ('cur', name))
+
+    #############################
+    def defer (self, name, interval, max_interval):
+        '''Return claimed entry name to new, counting a failed attempt.  It
+        is tried again after interval seconds, doubled for each earlier
+        attempt, up to max_interval.  Returns the number of attempts.
+        '''
+        base, attempts = (string.split (name, ',', 1) + ['0'])[:2]
+        try:
+            attempts = int (attempts) + 1
+        except ValueError:
+            attempts = 1
+        when = time.time () + min (max_interval,
+            interval * 2 ** min (attempts - 1, 30))
+        p = self._dir ('cur', name)
+        os.utime (p, (when, when))
+        os.rename (p, self._dir ('new', '%s,%d' % (base, attempts)))
+        return attempts
+
+# Spools by directory, so entries added by worker threads are committed
+# together
+spools = {}
+
+# Held while creating a spool, as batch workers may ask for one at once
+spools_lock = thread.allocate_lock ()
+
+#############################
+def get_confirmation_spool ():
+    '''Return the configured ConfirmationSpool, or None if confirmations
+    are sent directly.
+    '''
+    if not config['confirm_spool']:
+        return None
+    path = os.path.join (config['pymsgauth_dir'],
+        os.path.expanduser (config['confirm_spool']))
+    spools_lock.acquire ()
+    try:
+        try:
+            return spools[path]
+        except KeyError:
+            # Only one instance per path, so commit_confirmations () sees
+            # every confirmation added
+            spool = spools[path] = ConfirmationSpool (path)
+            return spool
+    finally:
+        spools_lock.release ()
+
+#############################
+def queue_confirmation (sender, recipient, token):
+    '''Spool the confirmation if confirm_spool is set (it is sent once
+    commit_confirmations () has been called and a flusher runs), else send
+    it now.
+    '''
+    spool = get_confirmation_spool ()
+    if spool is None:
+        send_confirmation (sender, recipient)
+        return
+    try:
+        start = time.time ()
+        spool.add (sender, recipient, token)
+        stats_timing ('spool', start)
+    except (IOError, OSError), txt:
+        log (WARN, 'Warning:  failed spooling confirmation to %s (%s), '
+            'sending it now', recipient, txt)
+        send_confirmation (sender, recipient)
+
+#############################
+def commit_confirmations ():
+    '''Commit every confirmation spooled by this process; see
+    ConfirmationSpool.commit ().  Must be called before the notices they
+    answer are dropped.
+    '''
+    for spool in spools.values ():
+        start = time.time ()
+        spool.commit ()
+        stats_timing ('spool_commit', start)
+
+#############################
+def confirm_notice (fp):
+    '''Handle the possible qsecretary notice read from file fp:  if it is
+    from a configured domain and quotes a message carrying an outstanding
+    token, claim the token and send the confirmation.  A notice for a token
+    already confirmed recently (see RecentConfirmations) is answered again
+    only if sending its confirmation failed; tokens are used once, so one
+    from any other address is not.  Returns CONFIRMED, DUPLICATE (already
+    answered), IGNORED (not a notice, or from an unknown domain), UNMATCHED
+    (no outstanding token) or FAILED (not configured to confirm).  Other
+    errors are raised.
+    '''
+    start = time.time ()
+    header = read_header_block (fp)
+    if string.find (header, 'qsecretary') == -1 \
+            and string.find (header, '\\') == -1:
+        # Cannot be from qsecretary; skip parsing
+        stats_timing ('parse', start)
+        log (TRACE, 'not a confirmation notice')
+        return IGNORED
+    import rfc822
+    import cStringIO
+    msg = rfc822.Message (cStringIO.StringIO (header), 0)
+    # The body is read straight from fp
+    msg.fp = fp
+    stats_timing ('parse', start)
+    from_name, from_addr = msg.getaddr ('from')
+    if from_name != 'The qsecretary program':
+        # Not a confirmation message
+        log (TRACE, 'not a confirmation notice (from "%s" <%s>)',
+            from_name or 'Unknown', from_addr or '<Unknown>')
+        return IGNORED
+
+    # Verify the message came from a domain we recognize
+    domain = string.split (from_addr, '@')[-1]
+    if not get_matcher ('confirm_domain').match_domain (domain):
+        # Didn't come from a site you wish to confirm
+        log (INFO, 'Ignored qsecretary notice (incorrect domain), from "%s"',
+            from_addr)
+        return IGNORED
+
+    # check message here
+    start = time.time ()
+    orig_msg = extract_original_message (msg)
+    stats_timing ('extract', start)
+    orig_token = string.strip (orig_msg.getheader (config['auth_field'], ''))
+    if orig_token:
+        log (TRACE, 'Received qsecretary notice with token %s.', orig_token)
+    elif config['message_index']:
+        # The field may have been stripped on the way; look the message up
+        start = time.time ()
+        orig_token = find_indexed_token (orig_msg) or ''
+        stats_timing ('index', start)
+        if orig_token:
+            log (INFO, 'Found token %s for notice without %s field, from %s.',
+                orig_token, config['auth_field'], from_addr)
+            stats_count ('indexed')
+    if not orig_token:
+        log (WARN, 'Warning:  failed to find token in message from %s.',
+            from_addr)
+
+    try:
+        source_addr = config['confirmation_address']
+    except KeyError:
+        log (ERROR, 'Error:  failed sending confirmation notice '
+            '(no confirmation_address configured)')
+        return FAILED
+
+    start = time.time ()
+    recent = get_recent_confirmations ()
+    known = []
+    if recent is None or not orig_token:
+        matched = check_token (orig_msg, orig_token)
+    else:
+        # Held while claiming, so a duplicate arriving at the same time
+        # finds this confirmation recorded
+        recent.lock ()
+        try:
+            matched = check_token (orig_msg, orig_token)
+            known = recent.note (orig_token, from_addr, matched)
+        finally:
+            recent.unlock ()
+    stats_timing ('token', start)
+    if not matched:
+        if string.lower (from_addr) in known:
+            log (INFO, 'Dropped duplicate qsecretary notice, from "%s", '
+                'token "%s"', from_addr, orig_token)
+            return DUPLICATE
+        if '!' + string.lower (from_addr) not in known:
+            log (ERROR, 'Error:  did not find matching token file (%s)',
+                orig_token)
+            return UNMATCHED
+        log (INFO, 'Token %s already confirmed, answering notice whose '
+            'confirmation failed.', orig_token)
+
+    # Confirm this confirmation notice
+    try:
+        queue_confirmation (source_addr, from_addr, orig_token)
+    except StandardError:
+        if recent is not None and orig_token:
+            # Let the notice be answered when it is delivered again
+            recent.lock ()
+            try:
+                recent.unsent (orig_token, from_addr)
+            finally:
+                recent.unlock ()
+        raise
+    log (INFO, 'Authenticated qsecretary notice, from "%s", token "%s"',
+        from_addr, orig_token)
+    return CONFIRMED
+
+#############################
+def process_qsecretary_message ():
+    try:
+        read_config ()
+        log (TRACE)
+        result = confirm_notice (sys.stdin)
+        stats_count (result_names[result])
+        if result in (CONFIRMED, DUPLICATE):
+            # Drop confirmation notice after replying, or once the reply is
+            # safely spooled
+            commit_confirmations ()
+            sys.exit (99)
+
+    except DeliveryError, txt:
+        stats_count ('failed')
+        log (FATAL, 'Fatal:  failed sending mail (%s)', txt)
+        sys.exit (txt.exitcode)
+
+    except StandardError, txt:
+        stats_count ('failed')
+        log (FATAL, 'Fatal:  caught exception (%s)', txt)
+        log_exception ()
+
+    # Either the message isn't a qsecretary notice from our message, or
+    # it did not match a recorded token, or we errored.
+    # Exit 0 to allow it to be delivered to user.
+    sys.exit (0)
+
+process_qsecretary_message = profiled ('confirm', process_qsecretary_message)
+
+#############################
+def maildir_notices (path):
+    '''Yield (description, open file, disposal function) for each message
+    in Maildir path.  Disposal marks the message seen and trashed, or
+    removes it if delete is true.
+    '''
+    # List both directories first; disposal moves messages into cur
+    names = []
+    for subdir in ('new', 'cur'):
+        dirname = os.path.join (path, subdir)
+        for name in os.listdir (dirname):
+            if name[0] != '.':
+                names.append ((os.path.join (dirname, name), name))
+    for (p, name) in names:
+        def dispose (delete, p=p, name=name):
+            if delete:
+                os.unlink (p)
+                return
+            # Maildir info is ":2," followed by the flags, in ASCII order
+            base, info = (string.split (name, ':2,', 1) + [''])[:2]
+            flags = {}
+            for flag in info + 'ST':
+                flags[flag] = 1
+            flags = flags.keys ()
+            flags.sort ()
+            os.rename (p, os.path.join (path, 'cur',
+                '%s:2,%s' % (base, string.join (flags, ''))))
+        try:
+            f = open (p, 'rb')
+        except IOError, o:
+            if o.errno == errno.ENOENT:
+                # Taken by another reader
+                continue
+            raise
+        yield p, f, dispose
+
+#############################
+def mbox_notices (path, mbox):
+    '''Yield (description, open file, disposal function) for each message
+    in mailbox.mbox instance mbox, opened from path.  Disposal flags the
+    message read and deleted, or removes it if delete is true; changes are
+    written when the caller flushes the mailbox.
+    '''
+    for key in mbox.keys ():
+        def dispose (delete, key=key):
+            if delete:
+                mbox.remove (key)
+                return
+            msg = mbox.get_message (key)
+            msg.add_flag ('RD')
+            mbox[key] = msg
+        # Copied, as the mailbox's file cannot be shared between workers
+        import cStringIO
+        yield ('%s#%s' % (path, key),
+            cStringIO.StringIO (mbox.get_string (key)), dispose)
+
+#############################
+def pool_map (func, items, workers):
+    '''Call func on each of items, yielding (item, result, error) tuples in
+    the order of items, where error is the exception func raised (if any);
+    a func which exits is reported as failing with a pymsgauthError.  With
+    more than one worker, calls are made from that many threads, and
+    at most 2 * workers items are taken from items ahead of the results
+    yielded.
+    '''
+    if workers <= 1:
+        for item in items:
+            try:
+                result = func (item)
+            except StandardError, txt:
+                yield item, None, txt
+            except SystemExit, o:
+                yield item, None, pymsgauthError ('exited %s' % o.code)
+            else:
+                yield item, result, None
+        return
+
+    import threading
+    import Queue
+    tasks = Queue.Queue ()
+    done = Queue.Queue ()
+    def worker ():
+        while 1:
+            task = tasks.get ()
+            if task is None:
+                return
+            seq, item = task
+            try:
+                done.put ((seq, item, func (item), None))
+            except StandardError, txt:
+                done.put ((seq, item, None, txt))
+            except SystemExit, o:
+                # Otherwise the thread would die with the item unreported,
+                # leaving the caller waiting for it forever
+                done.put ((seq, item, None,
+                    pymsgauthError ('exited %s' % o.code)))
+    threads = []
+    for i in range (workers):
+        t = threading.Thread (target=worker)
+        t.setDaemon (1)
+        t.start ()
+        threads.append (t)
+
+    # Results which have arrived ahead of an earlier item, by sequence number
+    finished = {}
+    submitted = reported = 0
+    items = iter (items)
+    try:
+        while 1:
+            while submitted - reported < workers * 2:
+                try:
+                    item = items.next ()
+                except StopIteration:
+                    break
+                tasks.put ((submitted, item))
+                submitted = submitted + 1
+            if reported == submitted:
+                break
+            while not finished.has_key (reported):
+                seq, item, result, error = done.get ()
+                finished[seq] = (item, result, error)
+            yield finished[reported]
+            del finished[reported]
+            reported = reported + 1
+    finally:
+        for t in threads:
+            tasks.put (None)
+        for t in threads:
+            t.join ()
+
+#############################
+def dispose_confirmed (confirmed, delete, counts):
+    '''Commit the spooled confirmations, then dispose of the notices they
+    answer, (description, disposal function, result) tuples in confirmed.
+    '''
+    try:
+        commit_confirmations ()
+    except StandardError, txt:
+        log (ERROR, 'Error:  failed sending confirmations (%s)', txt)
+        for (desc, dispose, result) in confirmed:
+            counts[FAILED] = counts[FAILED] + 1
+            stats_count (result_names[FAILED])
+        del confirmed[:]
+        return
+    for (desc, dispose, result) in confirmed:
+        try:
+            dispose (delete)
+        except StandardError, txt:
+            log (ERROR, 'Error:  failed handling %s (%s)', desc, txt)
+            result = FAILED
+        counts[result] = counts[result] + 1
+        stats_count (result_names[result])
+    del confirmed[:]
+
+#############################
+def confirm_notices (notices, delete, counts, workers):
+    def handle (notice):
+        desc, f, dispose = notice
+        try:
+            return confirm_notice (f)
+        finally:
+            f.close ()
+    # Confirmed notices are disposed of in batches, after one commit of
+    # their spooled confirmations
+    confirmed = []
+    for (notice, result, error) in pool_map (handle, notices, workers):
+        desc, f, dispose = notice
+        if error:
+            log (ERROR, 'Error:  failed handling %s (%s)', desc, error)
+            result = FAILED
+        elif result in (CONFIRMED, DUPLICATE):
+            confirmed.append ((desc, dispose, result))
+            if len (confirmed) >= spool_commit_batch \
+                    or get_confirmation_spool () is None:
+                dispose_confirmed (confirmed, delete, counts)
+            continue
+        counts[result] = counts[result] + 1
+        stats_count (result_names[result])
+    dispose_confirmed (confirmed, delete, counts)
+
+#############################
+def process_qsecretary_batch (args):
+    '''Handle every message in the Maildirs and mbox files named in args as
+    if it had been delivered to pymsgauth-confirm.  Confirmed and duplicate
+    notices are flagged as deleted (or removed, with -d); the rest are left
+    alone.  With -j, notices are handled by that many worker threads at
+    once (default confirm_workers).  Prints a summary, and exits 1 if any
+    message could not be handled.
+    '''
+    import getopt
+    import mailbox
+    usage = 'usage:  pymsgauth-confirm [-d] [-j workers] maildir|mbox ...\n'
+    try:
+        opts, paths = getopt.getopt (args, 'dj:')
+    except getopt.GetoptError, txt:
+        sys.stderr.write (usage)
+        sys.exit (100)
+    delete = 0
+    workers = None
+    for (opt, value) in opts:
+        if opt == '-d':
+            delete = 1
+        elif opt == '-j':
+            try:
+                workers = int (value)
+            except ValueError:
+                sys.stderr.write (usage)
+                sys.exit (100)
+
+    counts = {CONFIRMED : 0, IGNORED : 0, UNMATCHED : 0, FAILED : 0,
+        DUPLICATE : 0}
+    try:
+        read_config ()
+        log (TRACE)
+        if workers is None:
+            workers = config['confirm_workers']
+        for path in paths:
+            # A path which cannot be read counts as one failed message, and
+            # the rest are still handled
+            try:
+                if os.path.isdir (path):
+                    confirm_notices (maildir_notices (path), delete, counts,
+                        workers)
+                    continue
+                mbox = mailbox.mbox (path, create=False)
+                mbox.lock ()
+                try:
+                    confirm_notices (mbox_notices (path, mbox), delete,
+                        counts, workers)
+                    mbox.flush ()
+                finally:
+                    mbox.unlock ()
+                    mbox.close ()
+            except (StandardError, mailbox.Error), txt:
+                log (ERROR, 'Error:  failed handling %s (%s)', path, txt)
+                counts[FAILED] = counts[FAILED] + 1
+                stats_count (result_names[FAILED])
+
+    except StandardError, txt:
+        log (FATAL, 'Fatal:  caught exception (%s)', txt)
+        log_exception ()
+        counts[FAILED] = counts[FAILED] + 1
+
+    sys.stdout.write ('%d messages:  %d confirmed, %d duplicate, '
+        '%d ignored, %d unmatched, %d failed\n' % (reduce (lambda a, b: a + b,
+        counts.values ()), counts[CONFIRMED], counts[DUPLICATE],
+        counts[IGNORED], counts[UNMATCHED], counts[FAILED]))
+    if counts[FAILED]:
+        sys.exit (1)
+    sys.exit (0)
+
+#############################
+def flush_spool (spool, workers, counts):
+    '''Send every confirmation in spool which is due, workers at a time,
+    adding the number sent, deferred and given up on to counts.  Entries
+    for the same address are sent as one confirmation.
+    '''
+    if config['mail_timeout'] > 0:
+        stale = 2 * (config['mail_timeout'] + mail_kill_grace)
+    else:
+        stale = 3600
+    spool.recover (stale)
+    # Due entries, grouped by sender and recipient, oldest first
+    groups = {}
+    keys = []
+    for name in spool.ready ():
+        entry = spool.read (name)
+        if entry is None:
+            continue
+        key = (entry[0], string.lower (entry[1]))
+        if not groups.has_key (key):
+            groups[key] = []
+            keys.append (key)
+        groups[key].append (name)
+    def send (key):
+        '''Claim the entries for key and send one confirmation for them.
+        Returns the (name, entry) pairs claimed, and the error sending, if
+        any.
+        '''
+        claimed = []
+        for name in groups[key]:
+            entry = spool.claim (name)
+            # None if taken by another flusher
+            if entry is not None:
+                claimed.append ((name, entry))
+        if not claimed:
+            return claimed, None
+        sender, recipient, token = claimed[0][1]
+        try:
+            if not sender or not recipient:
+                raise DeliveryError ('malformed spool entry', 100)
+            send_confirmation (sender, recipient)
+        except StandardError, txt:
+            return claimed, txt
+        if len (claimed) > 1:
+            log (INFO, 'Coalesced %d confirmations to "%s".', len (claimed),
+                recipient)
+            stats_count ('coalesced')
+        return claimed, None
+    for (key, result, error) in pool_map (send, keys, workers):
+        if error is not None:
+            log (ERROR, 'Error:  failed claiming spooled confirmations to '
+                '%s (%s)', key[1], error)
+            counts['failed'] = counts['failed'] + 1
+            continue
+        claimed, error = result
+        for (name, entry) in claimed:
+            try:
+                if error is None:
+                    spool.done (name)
+                    log (INFO, 'Sent confirmation to "%s", token "%s"',
+                        entry[1], entry[2])
+                    counts['sent'] = counts['sent'] + 1
+                    stats_count ('flushed')
+                    continue
+                try:
+                    age = time.time () - int (string.split (name, '.', 1)[0])
+                except ValueError:
+                    age = 0
+                if getattr (error, 'exitcode', 111) == 100 \
+                        or age >= config['confirm_retry_lifetime']:
+                    log (ERROR, 'Error:  giving up on spooled confirmation '
+                        '%s (%s)', name, error)
+                    spool.done (name)
+                    counts['failed'] = counts['failed'] + 1
+                    stats_count ('flush_failed')
+                else:
+                    attempts = spool.defer (name,
+                        config['confirm_retry_interval'],
+                        config['confirm_retry_max_interval'])
+                    log (WARN, 'Warning:  failed sending spooled confirmation '
+                        '%s (%s), attempt %d', name, error, attempts)
+                    counts['deferred'] = counts['deferred'] + 1
+                    stats_count ('deferred')
+            except (IOError, OSError), txt:
+                log (ERROR, 'Error:  failed handling spooled confirmation %s '
+                    '(%s)', name, txt)
+                counts['failed'] = counts['failed'] + 1
+
+#############################
+def flush_confirmations (args):
+    '''Send the confirmations waiting in confirm_spool.  With -j, that many
+    are sent at once (default confirm_workers).  One which cannot be sent is
+    retried after confirm_retry_interval seconds, doubling each time up to
+    confirm_retry_max_interval, until it is confirm_retry_lifetime seconds
+    old or fails permanently.  With -i, keeps running, looking for
+    confirmations every that many seconds; otherwise prints a summary and
+    exits, 1 if any confirmation was given up on.
+    '''
+    import getopt
+    usage = 'usage:  pymsgauth-flush [-j workers] [-i seconds]\n'
+    try:
+        opts, args = getopt.getopt (args, 'j:i:')
+        if args:
+            raise getopt.GetoptError ('unexpected argument')
+        workers = None
+        interval = 0
+        for (opt, value) in opts:
+            if opt == '-j':
+                workers = int (value)
+            elif opt == '-i':
+                interval = float (value)
+    except (getopt.GetoptError, ValueError):
+        sys.stderr.write (usage)
+        sys.exit (100)
+
+    counts = {'sent' : 0, 'deferred' : 0, 'failed' : 0}
+    try:
+        while 1:
+            read_config ()
+            log (TRACE)
+            spool = get_confirmation_spool ()
+            if spool is None:
+                raise ConfigurationError, 'no confirm_spool configured'
+            start = time.time ()
+            flush_spool (spool, workers or config['confirm_workers'], counts)
+            stats_timing ('flush', start)
+            if not interval:
+                break
+            flush_log ()
+            flush_stats ()
+            time.sleep (interval)
+
+    except StandardError, txt:
+        log (FATAL, 'Fatal:  caught exception (%s)', txt)
+        log_exception ()
+        sys.exit (1)
+
+    sys.stdout.write ('%d confirmations:  %d sent, %d deferred, %d failed\n'
+        % (counts['sent'] + counts['deferred'] + counts['failed'],
+        counts['sent'], counts['deferred'], counts['failed']))
+    if counts['failed']:
+        sys.exit (1)
+    sys.exit (0)
+
+#############################
+def handle_daemon_request (conn):
+    '''Run one client request (see pymsgauthclient) in this process, with
+    the client's environment and working directory, stdin, stdout and
+    stderr redirected to buffers, and send back the result.  The daemon's
+    PYMSGAUTH_DIR is kept, as its configuration is the one in use.
+    '''
+    import cStringIO
+    import pymsgauthclient
+    fp = conn.makefile ('rb', pymsgauthclient.chunk_size)
+    command = pymsgauthclient.read_netstring (fp)
+    args = []
+    for i in range (int (pymsgauthclient.read_netstring (fp))):
+        args.append (pymsgauthclient.read_netstring (fp))
+    cwd = pymsgauthclient.read_netstring (fp)
+    environ = {}
+    for i in range (int (pymsgauthclient.read_netstring (fp))):
+        name, value = string.split (pymsgauthclient.read_netstring (fp),
+            '=', 1)
+        environ[name] = value
+    sys.stdin = cStringIO.StringIO (fp.read ())
+    fp.close ()
+
+    pymsgauth_dir = os.environ.get ('PYMSGAUTH_DIR')
+    os.environ.clear ()
+    os.environ.update (environ)
+    if pymsgauth_dir is None:
+        if os.environ.has_key ('PYMSGAUTH_DIR'):
+            del os.environ['PYMSGAUTH_DIR']
+    else:
+        os.environ['PYMSGAUTH_DIR'] = pymsgauth_dir
+    if cwd:
+        try:
+            os.chdir (cwd)
+        except OSError, txt:
+            log (WARN, 'Warning:  cannot change to %s (%s)', cwd, txt)
+    sys.stdout = cStringIO.StringIO ()
+    sys.stderr = cStringIO.StringIO ()
+
+    exitcode = 0
+    try:
+        try:
+            if command == 'mail':
+                sendmail_wrapper (args)
+            elif command == 'confirm':
+                process_qsecretary_message ()
+            elif command == 'clean':
+                clean_old_tokens ()
+            else:
+                log (ERROR, 'Error:  unknown daemon command "%s"', command)
+                exitcode = 111
+        except SystemExit, o:
+            exitcode = o.code or 0
+    finally:
+        flush_log ()
+        flush_stats ()
+        sys.stdout.flush ()
+        sys.stderr.flush ()
+    conn.sendall (pymsgauthclient.netstring (str (exitcode))
+        + pymsgauthclient.netstring (sys.stdout.getvalue ())
+        + pymsgauthclient.netstring (sys.stderr.getvalue ()))
+
+#############################
+def refuse_request (conn):
+    '''Tell the client on conn to handle its request itself, and close the
+    connection.  The request is read and discarded first, so the client is
+    not cut off while still sending it.
+    '''
+    import socket
+    import pymsgauthclient
+    conn.settimeout (refuse_timeout)
+    try:
+        while conn.recv (io_chunk_size):
+            pass
+        conn.sendall (pymsgauthclient.netstring (
+            pymsgauthclient.refused_reply))
+    except socket.error, txt:
+        log (DEBUG, 'failed refusing request (%s)', txt)
+    conn.close ()
+
+#############################
+def reap_children (signum=None, frame=None):
+    while 1:
+        try:
+            pid, status = os.waitpid (-1, os.WNOHANG)
+        except OSError:
+            return
+        if not pid:
+            return
+        child = tenant_children.pop (pid, None)
+        if child is not None:
+            uid, path, report = child
+            tenant_running[uid] = tenant_running[uid] - 1
+            if not tenant_running[uid]:
+                del tenant_running[uid]
+            snapshot = read_tenant_report (report)
+            if snapshot:
+                cache_tenant_config (path, snapshot)
+
+#############################
+def restore_config (snapshot):
+    '''Make snapshot, a (configuration, stamp, matchers) tuple, the current
+    configuration, after writing out log lines buffered under the old one.
+    '''
+    global config_stamp, stats_enabled, logfd
+    flush_log ()
+    if logfd:
+        logfd.close ()
+        logfd = None
+    saved, config_stamp, saved_matchers = snapshot
+    config.clear ()
+    config.update (saved)
+    matchers.clear ()
+    matchers.update (saved_matchers)
+    stats_enabled = config.get ('stats_file') or config.get ('stats_socket')
+
+#############################
+def peer_uid (conn):
+    '''Return the user id of the process at the other end of Unix socket
+    conn (Linux SO_PEERCRED).
+    '''
+    import socket
+    import struct
+    creds = conn.getsockopt (socket.SOL_SOCKET,
+        getattr (socket, 'SO_PEERCRED', 17), struct.calcsize ('3i'))
+    pid, uid, gid = struct.unpack ('3i', creds)
+    return uid
+
+#############################
+def load_tenant_config (path, report):
+    '''Make the configuration in user data directory path current, in a
+    request handler forked by the shared daemon and already switched to the
+    user.  The copy the daemon cached is used unless the file has changed
+    since; if it is read again, the result is written to file descriptor
+    report (see report_tenant_config ()) for the daemon to cache.  report
+    is closed.
+    '''
+    try:
+        entry = tenant_configs.get (path)
+        # Other users' configurations are not this process's business
+        tenant_configs.clear ()
+        if entry:
+            restore_config (entry[1])
+        else:
+            restore_config (({}, None, {}))
+        cached = config_stamp
+        os.environ['PYMSGAUTH_DIR'] = path
+        read_config ()
+        if config_stamp != cached:
+            report_tenant_config (report)
+        get_matcher ('token_recipient')
+        get_matcher ('confirm_domain')
+    finally:
+        os.close (report)
+
+#############################
+def encode_config_value (value, nested=0):
+    '''Encode value (None, a number, a string, or a list or tuple of these)
+    as a string for report_tenant_config ().  Raises TypeError for anything
+    else.
+    '''
+    import pymsgauthclient
+    kind = type (value)
+    if value is None:
+        return 'n'
+    if kind in (type (0), type (0L)):
+        return 'i%d' % value
+    if kind == type (0.0):
+        return 'f%r' % value
+    if kind == type (''):
+        return 's' + value
+    if kind in (type ([]), type (())) and not nested:
+        if kind == type ([]):
+            code = 'l'
+        else:
+            code = 't'
+        return code + string.join (map (lambda v: pymsgauthclient.netstring (
+            encode_config_value (v, 1)), value), '')
+    raise TypeError, 'cannot encode %s' % kind.__name__
+
+#############################
+def decode_config_value (data, nested=0):
+    '''Return the value encoded in data by encode_config_value ().  Raises
+    ValueError or pymsgauthclient.ProtocolError if data is not valid.
+    '''
+    import cStringIO
+    import pymsgauthclient
+    kind, rest = data[:1], data[1:]
+    if kind == 'n' and not rest:
+        return None
+    if kind == 'i':
+        return int (rest)
+    if kind == 'f':
+        return float (rest)
+    if kind == 's':
+        return rest
+    if kind in ('l', 't') and not nested:
+        fp = cStringIO.StringIO (rest)
+        values = []
+        while fp.tell () < len (rest):
+            values.append (decode_config_value (
+                pymsgauthclient.read_netstring (fp), 1))
+        if kind == 't':
+            return tuple (values)
+        return values
+    raise ValueError, 'bad configuration value'
+
+#############################
+def report_tenant_config (fd):
+    '''Write the current configuration to file descriptor fd, the write end
+    of a pipe from the shared daemon, as netstrings:  the configuration
+    stamp, then each option's name and encoded value.  Nothing is written
+    if the configuration cannot be encoded or is larger than
+    tenant_report_limit; the write never blocks.
+    '''
+    import fcntl
+    import pymsgauthclient
+    netstring = pymsgauthclient.netstring
+    try:
+        parts = [netstring (encode_config_value (config_stamp))]
+        for (option, value) in config.items ():
+            parts.append (netstring (option)
+                + netstring (encode_config_value (value)))
+    except TypeError, txt:
+        log (DEBUG, 'not reporting configuration (%s)', txt)
+        return
+    data = string.join (parts, '')
+    if len (data) > tenant_report_limit:
+        log (DEBUG, 'not reporting configuration (%d bytes)', len (data))
+        return
+    try:
+        # A short write is discarded by the daemon as truncated
+        fcntl.fcntl (fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        os.write (fd, data)
+    except OSError, txt:
+        log (DEBUG, 'failed reporting configuration (%s)', txt)
+
+#############################
+def read_tenant_report (fd):
+    '''Read the configuration report_tenant_config () wrote to file
+    descriptor fd, and close it.  Returns it as a snapshot for
+    restore_config (), or None if no complete, valid report was written.
+    Only a request handler which has exited is asked, so the report is
+    already in the pipe; the read never blocks.
+    '''
+    import fcntl
+    import cStringIO
+    import pymsgauthclient
+    data = ''
+    try:
+        fcntl.fcntl (fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        while len (data) <= tenant_report_limit:
+            try:
+                chunk = os.read (fd, tenant_report_limit + 1 - len (data))
+            except OSError:
+                # Nothing more, though the pipe is still open somewhere
+                break
+            if not chunk:
+                break
+            data = data + chunk
+    finally:
+        os.close (fd)
+    if not data or len (data) > tenant_report_limit:
+        return None
+    fp = cStringIO.StringIO (data)
+    options = {}
+    try:
+        stamp = decode_config_value (pymsgauthclient.read_netstring (fp))
+        while fp.tell () < len (data):
+            option = pymsgauthclient.read_netstring (fp)
+            options[option] = decode_config_value (
+                pymsgauthclient.read_netstring (fp))
+    except (ValueError, pymsgauthclient.ProtocolError), txt:
+        log (WARN, 'Warning:  ignoring bad configuration report (%s)', txt)
+        return None
+    if type (stamp) != type (()):
+        return None
+    return (options, stamp, {})
+
+#############################
+def cache_tenant_config (path, snapshot):
+    '''Keep snapshot as the configuration in user data directory path.  At
+    most tenant_cache_size users' configurations are kept; the least
+    recently used is dropped.
+    '''
+    global tenant_uses
+    tenant_uses = tenant_uses + 1
+    tenant_configs[path] = [tenant_uses, snapshot]
+    if len (tenant_configs) > config['tenant_cache_size']:
+        oldest = min (map (lambda (p, e): (e[0], p), tenant_configs.items ()))
+        del tenant_configs[oldest[1]]
+
+#############################
+def become_tenant (pw, limits):
+    '''Permanently switch this (forked, root) process to the user with
+    password entry pw, and apply the resource limits (CPU seconds, memory
+    in megabytes).
+    '''
+    import resource
+    if os.getuid () == 0:
+        os.initgroups (pw.pw_name, pw.pw_gid)
+        os.setgid (pw.pw_gid)
+        os.setuid (pw.pw_uid)
+    os.environ['HOME'] = pw.pw_dir
+    os.environ['USER'] = os.environ['LOGNAME'] = pw.pw_name
+    cpu, memory = limits
+    if cpu:
+        resource.setrlimit (resource.RLIMIT_CPU, (cpu, cpu + 5))
+    if memory:
+        resource.setrlimit (resource.RLIMIT_AS,
+            (memory * 1024 * 1024, memory * 1024 * 1024))
+
+#############################
+def serve_daemon (args):
+    '''Run pymsgauth as a resident server listening on a Unix socket.  The
+    configuration and modules are loaded once; each request is handled in a
+    forked child so a failure in one message cannot affect the server.
+
+    With -m, serve every user who connects (as root, on a socket anyone may
+    use):  each request is handled as the connecting user, with their
+    ~/.pymsgauth configuration and tokens, under the tenant_* limits.
+    '''
+    import getopt
+    import signal
+    import socket
+    import pymsgauthclient
+    try:
+        opts, args = getopt.getopt (args, 'm')
+    except getopt.GetoptError:
+        sys.stderr.write ('usage:  pymsgauth-daemon [-m] [socket]\n')
+        sys.exit (100)
+    shared = ('-m', '') in opts
+    for name in daemon_modules:
+        __import__ (name)
+    try:
+        read_config ()
+        if args:
+            path = args[0]
+        elif shared:
+            path = os.environ.get ('PYMSGAUTH_SOCKET',
+                pymsgauthclient.shared_socket_path)
+        else:
+            path = pymsgauthclient.socket_path ()
+        try:
+            os.unlink (path)
+        except OSError, o:
+            if o.errno != errno.ENOENT:
+                raise
+        server = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+        if shared:
+            # Any user may connect; requests run as whoever did
+            old_umask = os.umask (0)
+        else:
+            old_umask = os.umask (077)
+        try:
+            server.bind (path)
+        finally:
+            os.umask (old_umask)
+        server.listen (128)
+        log (INFO, 'Listening on %s.', path)
+        flush_log ()
+    except StandardError, txt:
+        log (FATAL, 'Fatal:  caught exception (%s)', txt)
+        log_exception ()
+        sys.exit (1)
+
+    if shared:
+        serve_tenants (server)
+    signal.signal (signal.SIGCHLD, reap_children)
+    while 1:
+        try:
+            conn, addr = server.accept ()
+        except socket.error, o:
+            if o.args[0] == errno.EINTR:
+                continue
+            raise
+        try:
+            # Pick up configuration changes before handing it to the child
+            read_config ()
+        except StandardError, txt:
+            log (ERROR, 'Error:  failed reloading configuration (%s)', txt)
+            refuse_request (conn)
+            continue
+        # Don't let the child inherit (and repeat) buffered log lines
+        flush_log ()
+        flush_stats ()
+        pid = os.fork ()
+        if pid:
+            conn.close ()
+            continue
+        # Child
+        server.close ()
+        signal.signal (signal.SIGCHLD, signal.SIG_DFL)
+        exitcode = 0
+        try:
+            try:
+                handle_daemon_request (conn)
+            except:
+                exitcode = 1
+                log (ERROR, 'Error:  failed handling request (%s)',
+                    sys.exc_info ()[1])
+        finally:
+            # os._exit () skips the atexit handlers
+            close_submitters ()
+            flush_log ()
+            flush_stats ()
+            os._exit (exitcode)
+
+#############################
+def serve_tenants (server):
+    '''Accept requests on server for a shared daemon; never returns.  Users'
+    files are only read by the request handlers, once switched to the user
+    and limited; they send back what they read for the daemon to cache.
+    '''
+    global tenant_uses
+    import pwd
+    import socket
+    while 1:
+        flush_log ()
+        try:
+            conn, addr = server.accept ()
+        except socket.error, o:
+            if o.args[0] == errno.EINTR:
+                continue
+            raise
+        # Finished handlers are collected here rather than from a SIGCHLD
+        # handler, so none can be missed between fork () and recording it
+        reap_children ()
+        try:
+            uid = peer_uid (conn)
+            pw = pwd.getpwuid (uid)
+        except (socket.error, KeyError), txt:
+            log (ERROR, 'Error:  cannot identify client (%s)', txt)
+            refuse_request (conn)
+            continue
+        if os.getuid () not in (0, uid):
+            # Cannot act as another user without root
+            log (ERROR, 'Error:  refusing request from user %s', pw.pw_name)
+            refuse_request (conn)
+            continue
+        if tenant_running.get (uid, 0) >= config['tenant_process_limit']:
+            # Refused; the client handles the message itself, at its own
+            # expense rather than the shared daemon's
+            log (WARN, 'Warning:  too many requests running for %s',
+                pw.pw_name)
+            refuse_request (conn)
+            continue
+        limits = (config['tenant_cpu_limit'], config['tenant_memory_limit'])
+        path = os.path.join (pw.pw_dir, '.pymsgauth')
+        entry = tenant_configs.get (path)
+        if entry:
+            tenant_uses = tenant_uses + 1
+            entry[0] = tenant_uses
+        try:
+            report, report_w = os.pipe ()
+        except OSError, txt:
+            log (ERROR, 'Error:  cannot handle request (%s)', txt)
+            refuse_request (conn)
+            continue
+        # Don't let the child inherit (and repeat) buffered log lines
+        flush_log ()
+        flush_stats ()
+        pid = os.fork ()
+        if pid:
+            os.close (report_w)
+            conn.close ()
+            tenant_children[pid] = (uid, path, report)
+            tenant_running[uid] = tenant_running.get (uid, 0) + 1
+            continue
+        # Child; other handlers' reports are not for this user to read
+        server.close ()
+        os.close (report)
+        for (other_uid, other_path, other_report) in tenant_children.values ():
+            os.close (other_report)
+        tenant_children.clear ()
+        exitcode = 0
+        try:
+            try:
+                become_tenant (pw, limits)
+                try:
+                    load_tenant_config (path, report_w)
+                except:
+                    # The client falls back to handling the message itself,
+                    # and reports the problem to the user
+                    log (ERROR, 'Error:  failed loading configuration for '
+                        '%s (%s)', pw.pw_name, sys.exc_info ()[1])
+                    refuse_request (conn)
+                else:
+                    handle_daemon_request (conn)
+            except:
+                exitcode = 1
+                log (ERROR, 'Error:  failed handling request (%s)',
+                    sys.exc_info ()[1])
+        finally:
+            # os._exit () skips the atexit handlers
+            close_submitters ()
+            flush_log ()
+            flush_stats ()
+            os._exit (exitcode)
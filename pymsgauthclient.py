@@ -0,0 +1,170 @@
+#!/usr/bin/python
+'''pymsgauthclient.py - Thin client handing pymsgauth commands to a running
+pymsgauth-daemon.
+Copyright (C) 2001 Charles Cazabon <software @ discworld.dyndns.org>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of version 2 of the GNU General Public License
+as published by the Free Software Foundation.  A copy of this license should
+be included in the file COPYING.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+This module deliberately imports nothing beyond what it needs to talk to the
+daemon, so the entry scripts start quickly when a daemon is running; socket
+is only imported once the daemon's socket is known to exist.
+
+Protocol, over a Unix stream socket:
+    client:  netstring (command), netstring (argument count), one netstring
+             per argument, netstring (working directory), netstring
+             (environment variable count), one netstring per variable
+             (NAME=value), then the raw message (stdin) until end-of-stream
+    daemon:  netstring (exit code), netstring (stdout), netstring (stderr);
+             or just netstring (refused_reply), if it will not handle the
+             request and has done nothing with it
+'''
+
+#
+# Imports
+#
+
+import sys
+import os
+
+#
+# Configuration constants
+#
+
+# Socket file name, in the configuration/data directory
+socket_filename = 'pymsgauth.sock'
+
+# Default socket of a shared (pymsgauth-daemon -m) daemon, used by users
+# without a daemon of their own
+shared_socket_path = '/var/run/pymsgauth.sock'
+
+# Size of reads from stdin and the socket
+chunk_size = 65536
+
+# Seconds to wait for the daemon to accept a connection before doing the
+# work in-process instead
+connect_timeout = 10
+
+# Seconds to wait for the daemon to answer a request; longer than the
+# default mail_timeout (600) plus the time to kill a mail command past it
+request_timeout = 900
+
+# Exit code when a request the daemon accepted fails; qmail will retry it
+tempfail_exitcode = 111
+
+# Reply from a daemon which will not handle a request, sent instead of an
+# exit code; the client then handles it itself
+refused_reply = 'refused'
+
+#############################
+class ProtocolError (Exception):
+    pass
+
+#############################
+def socket_path ():
+    '''Find the daemon socket without reading the configuration file.
+    '''
+    path = os.environ.get ('PYMSGAUTH_SOCKET')
+    if path:
+        return path
+    pymsgauth_dir = os.environ.get ('PYMSGAUTH_DIR')
+    if pymsgauth_dir:
+        return os.path.join (pymsgauth_dir, socket_filename)
+    # A shared daemon serves ~/.pymsgauth, so is only used when that is the
+    # configuration/data directory
+    path = os.path.join (os.path.expanduser ('~/.pymsgauth'), socket_filename)
+    if not os.path.exists (path) and os.path.exists (shared_socket_path):
+        return shared_socket_path
+    return path
+
+#############################
+def netstring (s):
+    return '%d:%s,' % (len (s), s)
+
+#############################
+def read_netstring (fp):
+    length = ''
+    while 1:
+        c = fp.read (1)
+        if c == ':':
+            break
+        if not c or not c.isdigit () or len (length) > 12:
+            raise ProtocolError, 'bad netstring length'
+        length = length + c
+    s = fp.read (int (length))
+    if len (s) != int (length) or fp.read (1) != ',':
+        raise ProtocolError, 'truncated netstring'
+    return s
+
+#############################
+def run (command, args):
+    '''Hand command to the daemon and exit with its exit code.  Returns
+    normally (with sys.stdin still holding the complete message) if there
+    is no daemon, it does not accept the connection, or it refuses the
+    request, so the caller can fall back to doing the work in-process.
+    Once connected, the daemon may already have sent or confirmed mail, so
+    any failure after that exits tempfail_exitcode instead.
+    '''
+    path = socket_path ()
+    if not os.path.exists (path):
+        return
+    import socket
+    s = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout (connect_timeout)
+    try:
+        s.connect (path)
+    except socket.error:
+        s.close ()
+        return
+    s.settimeout (request_timeout)
+
+    data = sys.stdin.read ()
+    try:
+        request = [netstring (command), netstring (str (len (args)))]
+        for arg in args:
+            request.append (netstring (arg))
+        # The daemon runs the command with the caller's environment and
+        # working directory, as it would have run here
+        try:
+            cwd = os.getcwd ()
+        except OSError:
+            cwd = ''
+        request.append (netstring (cwd))
+        request.append (netstring (str (len (os.environ))))
+        for (name, value) in os.environ.items ():
+            request.append (netstring ('%s=%s' % (name, value)))
+        s.sendall (''.join (request))
+        s.sendall (data)
+        s.shutdown (socket.SHUT_WR)
+        fp = s.makefile ('rb', chunk_size)
+        status = read_netstring (fp)
+        if status != refused_reply:
+            exitcode = int (status)
+            out = read_netstring (fp)
+            err = read_netstring (fp)
+        s.close ()
+    except (socket.error, ProtocolError, ValueError), txt:
+        # The request may have been carried out; let qmail retry it rather
+        # than risk doing it twice
+        s.close ()
+        sys.stderr.write ('pymsgauth:  daemon request failed (%s)\n' % txt)
+        sys.exit (tempfail_exitcode)
+    if status == refused_reply:
+        import cStringIO
+        sys.stdin = cStringIO.StringIO (data)
+        return
+
+    sys.stdout.write (out)
+    sys.stderr.write (err)
+    sys.exit (exitcode)